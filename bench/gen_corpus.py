@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+# SPDX-FileCopyrightText: 2021 Markus Linnala <markus.linnala@cybercom.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Deterministic corpus of exported CIL modules looking like Fedora policy:
+# allow rules of real classes, typeattributeset with members and logical
+# expressions, typetransitions with and without file names, nested
+# optional and booleanif blocks and cil_gen_require statements. Same seed
+# and scale give byte for byte same files.
+#
+#   bench/gen_corpus.py --modules 400 OUT
+#
+# writes OUT/export/*.cil and OUT/from/*.cil, latter being modules whose
+# rules are partly found in export.
+
+import argparse
+import os
+import random
+from typing import (
+    List,
+)
+
+classes = {
+    "file": "ioctl read write create getattr setattr lock append unlink link rename open map execute".split(),
+    "dir": "ioctl read write create getattr setattr lock add_name remove_name search rmdir open".split(),
+    "lnk_file": "read getattr create unlink".split(),
+    "sock_file": "write getattr create unlink".split(),
+    "unix_stream_socket": "connectto read write create getattr".split(),
+    "process": "fork transition sigchld sigkill signal getattr setexec setpgid".split(),
+    "capability": "chown dac_override dac_read_search fowner kill setgid setuid net_admin sys_admin".split(),
+    "tcp_socket": "name_bind name_connect create read write getattr".split(),
+}
+file_classes = ["file", "dir", "lnk_file", "sock_file"]
+words = """
+    abrt accounts alsa apache audit avahi bluetooth boot cron cups dbus dhcp dns
+    fs gpg init ipsec kernel ldap lvm mail mount ntp nfs postfix pulse rpc rpm
+    samba ssh sssd sudo systemd udev user virt xdm
+""".split()
+suffixes = [
+    "t",
+    "exec_t",
+    "var_run_t",
+    "log_t",
+    "tmp_t",
+    "etc_t",
+    "port_t",
+    "var_lib_t",
+]
+
+
+class Corpus:
+    def __init__(self, seed: int, modules: int) -> None:
+        self.rnd = random.Random(seed)
+        self.modules = modules
+        # Types grow with modules like in real policy
+        self.types = sorted(
+            {
+                f"{self.rnd.choice(words)}{self.rnd.randint(0, modules)}_{s}"
+                for _ in range(modules * 12)
+                for s in [self.rnd.choice(suffixes)]
+            }
+        )
+        self.attrs = sorted(
+            {f"{w}_{a}" for w in words for a in ("domain", "file_type", "port_type")}
+        )
+        self.booleans = [f"{w}_use_{x}" for w in words for x in ("nfs", "tcp")]
+        self.optional_idx = 0
+
+    def type_name(self) -> str:
+        # Few types are used a lot, most only a little
+        return self.types[int(len(self.types) * self.rnd.random() ** 2)]
+
+    def source(self) -> str:
+        if self.rnd.random() < 0.15:
+            return self.rnd.choice(self.attrs)
+        return self.type_name()
+
+    def target(self) -> str:
+        r = self.rnd.random()
+        if r < 0.1:
+            return "self"
+        if r < 0.3:
+            return self.rnd.choice(self.attrs)
+        return self.type_name()
+
+    def perms(self, klass: str) -> str:
+        perms = classes[klass]
+        return " ".join(self.rnd.sample(perms, self.rnd.randint(1, min(6, len(perms)))))
+
+    def te_rule(self, kind: str = "") -> str:
+        if not kind:
+            kind = self.rnd.choice(
+                ["allow"] * 20 + ["dontaudit"] * 3 + ["auditallow", "neverallow"]
+            )
+        klass = self.rnd.choice(list(classes))
+        return (
+            f"({kind} {self.source()} {self.target()} ({klass} ({self.perms(klass)})))"
+        )
+
+    def typetransition(self) -> str:
+        klass = self.rnd.choice(file_classes + ["process"])
+        subject, source, target = self.type_name(), self.type_name(), self.type_name()
+        if klass != "process" and self.rnd.random() < 0.4:
+            name = self.rnd.choice(["log", ".ssh", "run", "tmp", "lock", "config"])
+            return f'(typetransition {subject} {source} {klass} "{name}" {target})'
+        return f"(typetransition {subject} {source} {klass} {target})"
+
+    def typeattributeset(self) -> str:
+        attr = self.rnd.choice(self.attrs)
+        r = self.rnd.random()
+        if r < 0.1:
+            return f"(typeattributeset {attr} (and ({self.rnd.choice(self.attrs)}) (not ({self.type_name()}))))"
+        if r < 0.15:
+            return f"(typeattributeset {attr} (not ({self.type_name()} {self.type_name()})))"
+        members = " ".join(self.type_name() for _ in range(self.rnd.randint(1, 4)))
+        return f"(typeattributeset {attr} ({members}))"
+
+    def condition(self) -> str:
+        r = self.rnd.random()
+        b = self.rnd.choice(self.booleans)
+        if r < 0.7:
+            return f"({b})"
+        if r < 0.85:
+            return f"(not ({b}))"
+        return f"(and ({b}) ({self.rnd.choice(self.booleans)}))"
+
+    def statements(self, count: int, depth: int = 0) -> List[str]:
+        res = []
+        for _ in range(count):
+            r = self.rnd.random()
+            if r < 0.7:
+                res.append(self.te_rule())
+            elif r < 0.78:
+                res.append(self.typetransition())
+            elif r < 0.85:
+                res.append(self.typeattributeset())
+            elif r < 0.9:
+                res.append(f"(typeattributeset cil_gen_require {self.type_name()})")
+            elif r < 0.95 and depth < 3:
+                self.optional_idx += 1
+                inner = self.statements(self.rnd.randint(1, 8), depth + 1)
+                res.append(f"(optional optional_{self.optional_idx} {' '.join(inner)})")
+            elif depth < 3:
+                branches = [
+                    f"(true {' '.join(self.statements(self.rnd.randint(1, 4), depth + 1))})"
+                ]
+                if self.rnd.random() < 0.5:
+                    branches.append(
+                        f"(false {' '.join(self.statements(self.rnd.randint(1, 4), depth + 1))})"
+                    )
+                res.append(f"(booleanif {self.condition()} {' '.join(branches)})")
+            else:
+                res.append(f"(type {self.type_name()})")
+        return res
+
+    def module(self, rules: int) -> List[str]:
+        # Sizes are skewed like in real policy: few large modules
+        return self.statements(max(1, int(rules * self.rnd.expovariate(1.0))))
+
+    def from_module(self, exported: List[str]) -> List[str]:
+        # Half of rules come from export, some of them with changed perms
+        res = []
+        for _ in range(self.rnd.randint(5, 40)):
+            r = self.rnd.random()
+            if r < 0.5 and exported:
+                res.append(self.rnd.choice(exported))
+            elif r < 0.6 and exported:
+                stmt = self.rnd.choice(exported)
+                if stmt.startswith("(allow ") and stmt.count("(") == 3:
+                    klass = stmt.split("(")[2].split()[0]
+                    stmt = stmt.replace(
+                        f"({klass} (",
+                        f"({klass} ({self.rnd.choice(classes[klass])} ",
+                        1,
+                    )
+                res.append(stmt)
+            elif r < 0.9:
+                res.append(self.te_rule("allow"))
+            else:
+                res.append(self.typetransition())
+        return res
+
+
+def write_module(path: str, statements: List[str]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(statements) + "\n")
+
+
+def generate(out: str, modules: int, rules: int, from_modules: int, seed: int) -> None:
+    corpus = Corpus(seed, modules)
+    os.makedirs(os.path.join(out, "export"), exist_ok=True)
+    os.makedirs(os.path.join(out, "from"), exist_ok=True)
+    exported: List[str] = []
+    for idx in range(modules):
+        statements = corpus.module(rules)
+        exported.extend(
+            s for s in statements if s.startswith(("(allow ", "(typetransition "))
+        )
+        write_module(os.path.join(out, "export", f"mod{idx}.cil"), statements)
+    for idx in range(from_modules):
+        write_module(
+            os.path.join(out, "from", f"from{idx}.cil"), corpus.from_module(exported)
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate synthetic CIL corpus")
+    parser.add_argument("out", help="directory to write export/ and from/ to")
+    parser.add_argument("--modules", type=int, default=400)
+    parser.add_argument(
+        "--rules", type=int, default=250, help="mean statements per module"
+    )
+    parser.add_argument("--from-modules", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    generate(args.out, args.modules, args.rules, args.from_modules, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+
+# SPDX-FileCopyrightText: 2021 Markus Linnala <markus.linnala@cybercom.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Benchmarks of simple-cil-parser.py on corpus from gen_corpus.py:
+# parse throughput, cache build, point queries from cache and from
+# --export-index, reverse queries through attributes, --from per file and
+# in one process, --check-neverallow, and peak RSS of each. Results are written as JSON, and
+# with --baseline compared to earlier results:
+#
+#   bench/run.py --output tmp/bench.json
+#   bench/run.py --baseline tmp/bench.json --output tmp/bench-new.json
+#
+# Exit code is 1 when some result is worse than baseline by more than
+# --threshold percent.
+
+import argparse
+import glob
+import importlib.util
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from types import ModuleType
+from typing import (
+    Any,
+    Dict,
+    List,
+    Tuple,
+)
+
+import gen_corpus
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+default_prog = os.path.join(os.path.dirname(bench_dir), "simple-cil-parser.py")
+
+
+def run(cmd: List[str], cwd: str) -> Tuple[float, float, int]:
+    # Seconds to first line of output and to exit, and peak RSS in KiB
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    assert proc.stdout is not None
+    proc.stdout.readline()
+    first = time.perf_counter() - start
+    proc.stdout.read()
+    proc.stdout.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    total = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        sys.exit(f"failed with {proc.returncode}: {' '.join(cmd)}")
+    return first, total, rusage.ru_maxrss
+
+
+def cil_files(workdir: str, subdir: str) -> List[str]:
+    # Relative to workdir like in Makefile
+    files = glob.glob(os.path.join(workdir, subdir, "*.cil"))
+    return sorted(os.path.relpath(f, workdir) for f in files)
+
+
+def latencies(times: List[float]) -> Dict[str, float]:
+    times = sorted(times)
+    return {
+        "median_s": statistics.median(times),
+        "p90_s": times[math.ceil(0.9 * len(times)) - 1],
+        "min_s": times[0],
+    }
+
+
+def load_prog(prog: str) -> ModuleType:
+    spec = importlib.util.spec_from_file_location("simple_cil_parser", prog)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_parse(prog: str, files: List[str], parser: str) -> Dict[str, Any]:
+    # Reading and flattening in this process, like refresh does per file
+    module = load_prog(prog)
+    size = sum(os.path.getsize(f) for f in files)
+    rules = 0
+    start = time.perf_counter()
+    for f in files:
+        store = module.parse_cache_rows(f, parser).rules
+        rules += len(store.te_rules) + len(store.typeattributes)
+        rules += len(store.typetransitions)
+    seconds = time.perf_counter() - start
+    return {
+        "parser": parser,
+        "files": len(files),
+        "bytes": size,
+        "rules": rules,
+        "seconds": seconds,
+        "mb_per_s": size / seconds / 1e6,
+        "rules_per_s": rules / seconds,
+        "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench_cache_build(prog: str, workdir: str, jobs: int) -> Dict[str, Any]:
+    for f in glob.glob(os.path.join(workdir, "export", "cache.*")):
+        os.unlink(f)
+    exports = cil_files(workdir, "export")
+    cmd = [sys.executable, prog, "--jobs", str(jobs), *exports]
+    _, total, rss = run(cmd, workdir)
+    return {"jobs": jobs, "files": len(exports), "seconds": total, "rss_kb": rss}
+
+
+def bench_queries(
+    prog: str, workdir: str, name: str, queries: List[List[str]], runs: int
+) -> Dict[str, Any]:
+    firsts, totals, rss = [], [], 0
+    for query in queries:
+        cmd = [sys.executable, prog, *query]
+        for _ in range(runs):
+            first, total, r = run(cmd, workdir)
+            firsts.append(first)
+            totals.append(total)
+            rss = max(rss, r)
+    print(f"# {name}: {statistics.median(totals):.3f} s", file=sys.stderr)
+    return {
+        "queries": len(queries),
+        "runs": runs,
+        "first_result": latencies(firsts),
+        "total": latencies(totals),
+        "rss_kb": rss,
+    }
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    res: Dict[str, float] = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            res.update(flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, float) or k == "rss_kb":
+            res[f"{prefix}{k}"] = v
+    return res
+
+
+def compare(
+    baseline: Dict[str, Any], results: Dict[str, Any], threshold: float
+) -> bool:
+    # Throughput should not go down, times and memory should not go up.
+    # Minimum and p90 are too noisy for this.
+    old = flatten(baseline["results"])
+    ok = True
+    for key, value in flatten(results["results"]).items():
+        if key not in old or not old[key]:
+            continue
+        if not key.endswith(("median_s", "seconds", "_per_s", "rss_kb")):
+            continue
+        change = (value - old[key]) / old[key] * 100
+        worse = -change if key.endswith("_per_s") else change
+        mark = ""
+        if worse > threshold:
+            mark = " REGRESSION"
+            ok = False
+        print(f"{key}: {old[key]:.4g} -> {value:.4g} ({change:+.1f}%){mark}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark simple-cil-parser.py")
+    parser.add_argument("--prog", default=default_prog)
+    parser.add_argument("--workdir", default="tmp/bench")
+    parser.add_argument("--modules", type=int, default=400)
+    parser.add_argument("--rules", type=int, default=250)
+    parser.add_argument("--from-modules", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=3, help="runs of each query")
+    parser.add_argument("--output", default="tmp/bench.json")
+    parser.add_argument("--baseline", help="earlier --output to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    args = parser.parse_args()
+
+    prog = os.path.abspath(args.prog)
+    corpus = {
+        "modules": args.modules,
+        "rules": args.rules,
+        "from_modules": args.from_modules,
+        "seed": args.seed,
+    }
+    # Corpus is generated again only when its parameters change
+    corpus_file = os.path.join(args.workdir, "corpus.json")
+    try:
+        with open(corpus_file, encoding="utf-8") as f:
+            same_corpus = json.load(f) == corpus
+    except (OSError, ValueError):
+        same_corpus = False
+    if not same_corpus:
+        shutil.rmtree(args.workdir, ignore_errors=True)
+        gen_corpus.generate(
+            args.workdir, args.modules, args.rules, args.from_modules, args.seed
+        )
+        with open(corpus_file, "w", encoding="utf-8") as f:
+            json.dump(corpus, f)
+
+    workdir = os.path.abspath(args.workdir)
+    exports = sorted(glob.glob(os.path.join(workdir, "export", "*.cil")))
+    froms = cil_files(workdir, "from")
+    # Most used types of corpus, see Corpus.type_name
+    types = gen_corpus.Corpus(args.seed, args.modules).types[:5]
+    outdir = os.path.join(workdir, "logs")
+    os.makedirs(outdir, exist_ok=True)
+
+    results: Dict[str, Any] = {}
+    results["parse"] = bench_parse(prog, exports, "builtin")
+    print(f"# parse: {results['parse']['mb_per_s']:.2f} MB/s", file=sys.stderr)
+    results["cache_build"] = bench_cache_build(prog, workdir, args.jobs)
+    print(f"# cache_build: {results['cache_build']['seconds']:.3f} s", file=sys.stderr)
+    results["point_query"] = bench_queries(
+        prog,
+        workdir,
+        "point_query",
+        [["--from-all-known", "--source", t] for t in types],
+        args.runs,
+    )
+    results["from"] = bench_queries(
+        prog,
+        workdir,
+        "from",
+        [["--from-all-known", "--from", f] for f in froms],
+        1,
+    )
+    _, total, rss = run(
+        [sys.executable, prog, "--from-all-known", "--export-index"], workdir
+    )
+    results["index_build"] = {"seconds": total, "rss_kb": rss}
+    results["point_query_index"] = bench_queries(
+        prog,
+        workdir,
+        "point_query_index",
+        [["--from-all-known", "--index", "--source", t] for t in types],
+        args.runs,
+    )
+    results["reverse_query"] = bench_queries(
+        prog,
+        workdir,
+        "reverse_query",
+        [["--from-all-known", "--reverse-target", "--target", t] for t in types],
+        args.runs,
+    )
+    results["check_neverallow"] = bench_queries(
+        prog,
+        workdir,
+        "check_neverallow",
+        [["--from-all-known", "--check-neverallow"]],
+        args.runs,
+    )
+    results["from_batch"] = bench_queries(
+        prog,
+        workdir,
+        "from_batch",
+        [["--from-all-known", "--from", "from", "--output-dir", outdir]],
+        args.runs,
+    )
+    results["peak_rss_kb"] = max(
+        r["rss_kb"] for r in results.values() if isinstance(r, dict) and "rss_kb" in r
+    )
+
+    git = subprocess.run(
+        ["git", "describe", "--always", "--dirty"],
+        cwd=os.path.dirname(prog),
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    output = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git.stdout.strip(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "corpus": corpus,
+        },
+        "results": results,
+    }
+    tmp = f"{args.output}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=2)
+        f.write("\n")
+    os.replace(tmp, args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(baseline, output, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+# SPDX-FileCopyrightText: 2021 Markus Linnala <markus.linnala@cybercom.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+# Time from start of simple-cil-parser.py process to its first line of
+# output, and to its exit. Search arguments come after --, for example:
+#
+#   bench/startup.py -- --from-all-known --source init_t
+#
+# Run in directory having export/cache.db, so that nothing is parsed.
+# Result is one JSON line, times in seconds.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import (
+    List,
+    Tuple,
+)
+
+default_prog = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "simple-cil-parser.py",
+)
+
+
+def run_once(cmd: List[str]) -> Tuple[float, float]:
+    start = time.perf_counter()
+    with subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    ) as proc:
+        assert proc.stdout is not None
+        proc.stdout.readline()
+        first = time.perf_counter() - start
+        proc.stdout.read()
+    total = time.perf_counter() - start
+    if proc.returncode != 0:
+        sys.exit(f"failed with {proc.returncode}: {' '.join(cmd)}")
+    return first, total
+
+
+def imported_modules(cmd: List[str]) -> List[str]:
+    # Top level modules imported by whole run, from -X importtime
+    res = subprocess.run(
+        [cmd[0], "-X", "importtime", *cmd[1:]],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    modules = set()
+    for line in res.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return sorted(modules)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Startup time of searches")
+    parser.add_argument("--prog", default=default_prog)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("search", nargs="+", help="arguments of search")
+    args = parser.parse_args()
+
+    cmd = [sys.executable, args.prog, *args.search]
+    # First run may refresh cache
+    run_once(cmd)
+    firsts, totals = zip(*(run_once(cmd) for _ in range(args.runs)))
+    modules = imported_modules(cmd)
+    print(
+        json.dumps(
+            {
+                "bench": "startup",
+                "args": args.search,
+                "runs": args.runs,
+                "first_result_median": statistics.median(firsts),
+                "first_result_min": min(firsts),
+                "total_median": statistics.median(totals),
+                "total_min": min(totals),
+                "parsimonious_imported": "parsimonious" in modules,
+                "multiprocessing_imported": "multiprocessing" in modules,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
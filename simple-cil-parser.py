@@ -7,67 +7,77 @@
 # pylint: disable=too-many-lines
 
 import argparse
+from array import array
+import bisect
 from collections import defaultdict
-import copy
+import contextlib
 from dataclasses import (
     dataclass,
-    field,
 )
 from enum import (
     Enum,
     auto,
 )
 
+import functools
+import glob
+import hashlib
+import io
 import json
+import mmap
+import operator
 import os
 
 import random
+import re
+import socket
+import socketserver
 import sqlite3
 import string
 
 import sys
+import threading
+import time
+import traceback
 
 from typing import (
-    # cast,
+    cast,
     Any,
-    # Callable,
+    Callable,
     # Collection,
     # Counter,
     Dict,
     DefaultDict,
     FrozenSet,
+    Generic,
     # Generator,
-    # Iterator,
+    Iterable,
+    Iterator,
     List,
     # Mapping,
     # NewType,
     Optional,
     Sequence,
     Set,
-    # TextIO,
+    TextIO,
     Tuple,
-    # TypeVar,
-    # TYPE_CHECKING,
+    TypeVar,
+    TYPE_CHECKING,
     Union,
 )
 
-import parsimonious
-from parsimonious.grammar import Grammar
-from parsimonious.nodes import Node
+if TYPE_CHECKING:
+    import parsimonious
 
 
 CilExpression = List[Union[str, List[Any]]]
-TERulesSql = List[Dict[str, str]]
-TASetsSql = List[Dict[str, Union[str, bool]]]
-TypetransitionsSql = List[Dict[str, Optional[str]]]
-ParsedCil = Tuple[List["TERule"], List["TASet"], List["Typetransition"]]
 
 
 sys.setrecursionlimit(10**4)
 
 
-grammar = Grammar(
-    r"""
+# Grammar of --parser parsimonious, see parsimonious_parser
+cil_grammar = r"""
     exprs = s_expr+
     s_expr = lpar items* rpar
     items = item _
@@ -81,54 +91,152 @@ grammar = Grammar(
     # / is used in paths: see base-module genfscon
     symbol = ~r"[-/\w]+"
 
-    _ = ( ~r"\s+" / ~r";[^\r\n]+" )*
+    _ = ( ~r"\s+" / ~r";[^\r\n]*" )*
     lpar = _ "(" _
     rpar = _ ")" _
-    """
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def parsimonious_parser() -> Tuple["parsimonious.Grammar", "parsimonious.NodeVisitor"]:
+    # Importing parsimonious and compiling grammar take longer than most
+    # searches of cached files, so they are done only when first needed.
+    # pylint: disable=import-outside-toplevel
+    import parsimonious
+    from parsimonious.nodes import Node
+
+    class CilParser(parsimonious.NodeVisitor):
+        # pylint: disable=no-self-use, unused-argument
+        def visit_s_expr(self, node: Node, visited_children: List[Any]) -> List[Any]:
+            # Go into items 2nd in definition (index 1) and extend to not to
+            # create new level here needlessly.
+            v = []
+            for c in visited_children[1]:
+                v.extend(c)
+            return v
+
+        def visit_item(
+            self, node: Node, visited_children: List[List[Any]]
+        ) -> List[Any]:
+            # Only one child possible, no new level.
+            return visited_children[0]
+
+        def visit_literal(self, node: Node, visited_children: Any) -> str:
+            # No resolution, just use text as is.
+            # quoted strings start / end "
+            # others are symbols
+            text: str = node.children[0].text
+            return text
+
+        def visit_lpar(self, node: Node, visited_children: Any) -> None:
+            return None
+
+        def visit_rpar(self, node: Node, visited_children: Any) -> None:
+            return None
+
+        def visit__(self, node: Node, visited_children: Any) -> None:
+            return None
+
+        def generic_visit(
+            self, node: Node, visited_children: Optional[List[Node]]
+        ) -> Union[List[Node], Node]:
+            # Drop _, (, )
+            v = []
+            if visited_children:
+                for c in visited_children:
+                    if c is not None:
+                        v.append(c)
+                return v
+            return node
+
+    return parsimonious.Grammar(cil_grammar), CilParser()
+
+
+# Same token set as in grammar above. Whitespace and comments are matched
+# without a group so lastindex is None for them. Anything else is an error.
+cil_token_re = re.compile(
+    r"""\s+|;[^\r\n]*|(\()|(\))|("[^\"]*"|[-/\w]+)|(.)""",
+    re.DOTALL,
 )
 
 
-class CilParser(parsimonious.NodeVisitor):
-    # pylint: disable=no-self-use, unused-argument
-    def visit_s_expr(self, node: Node, visited_children: List[Any]) -> List[Any]:
-        # Go into items 2nd in definition (index 1) and extend to not to
-        # create new level here needlessly.
-        v = []
-        for c in visited_children[1]:
-            v.extend(c)
-        return v
-
-    def visit_item(self, node: Node, visited_children: List[List[Any]]) -> List[Any]:
-        # Only one child possible, no new level.
-        return visited_children[0]
-
-    def visit_literal(self, node: Node, visited_children: Any) -> str:
-        # No resolution, just use text as is.
-        # quoted strings start / end "
-        # others are symbols
-        text: str = node.children[0].text
-        return text
-
-    def visit_lpar(self, node: Node, visited_children: Any) -> None:
-        return None
+def cil_syntax_error(text: str, pos: int, msg: str) -> ValueError:
+    line = text.count("\n", 0, pos) + 1
+    column = pos - text.rfind("\n", 0, pos)
+    return ValueError(f"{msg} at line {line}, column {column}")
 
-    def visit_rpar(self, node: Node, visited_children: Any) -> None:
-        return None
 
-    def visit__(self, node: Node, visited_children: Any) -> None:
-        return None
+def read_cil(text: str) -> List[Any]:
+    # Non-recursive reader producing same nested lists as CilParser, but
+    # without building parse tree first.
+    exprs: List[Any] = []
+    stack: List[List[Any]] = []
+    cur = exprs
+    for m in cil_token_re.finditer(text):
+        kind = m.lastindex
+        if kind is None:
+            continue
+        if kind == 1:
+            new: List[Any] = []
+            cur.append(new)
+            stack.append(cur)
+            cur = new
+        elif kind == 2:
+            if not stack:
+                raise cil_syntax_error(text, m.start(), "Unexpected ')'")
+            cur = stack.pop()
+        elif kind == 3 and stack:
+            cur.append(m.group(3))
+        else:
+            raise cil_syntax_error(text, m.start(), f"Unexpected {m.group()!r}")
+    if stack:
+        raise cil_syntax_error(text, len(text), "Missing ')'")
+    if not exprs:
+        raise cil_syntax_error(text, len(text), "No expressions")
+    return exprs
 
-    def generic_visit(
-        self, node: Node, visited_children: Optional[List[Node]]
-    ) -> Union[List[Node], Node]:
-        # Drop _, (, )
-        v = []
-        if visited_children:
-            for c in visited_children:
-                if c is not None:
-                    v.append(c)
-            return v
-        return node
+
+cil_parsers = ("builtin", "parsimonious")
+
+
+def parse_cil(text: str, parser: str = "builtin") -> List[Any]:
+    if parser == "parsimonious":
+        grammar, cilp = parsimonious_parser()
+        res: List[Any] = cilp.visit(grammar.parse(text))
+        return res
+    return read_cil(text)
+
+
+def check_parser(files: Sequence[str]) -> bool:
+    # Differential test: builtin reader must give same result as grammar.
+    # pylint: disable=import-outside-toplevel
+    from parsimonious import ParseError
+
+    ok = True
+    for file1 in files:
+        with open(file1, "r") as fd:
+            text = fd.read()
+        res: List[Optional[List[Any]]] = []
+        for parser in cil_parsers:
+            try:
+                res.append(parse_cil(text, parser))
+            except (ValueError, ParseError):
+                # Both must reject same input, messages differ
+                res.append(None)
+        if res[0] != res[1]:
+            ok = False
+            print(f"# mismatch: {file1}")
+            for parser, r in zip(cil_parsers, res):
+                print(f"# {parser}: {r}")
+            continue
+        print(f"# ok: {file1}")
+        print(json.dumps(res[0]))
+    return ok
+
+
+def expr_key(e: List[Any]) -> Tuple[Any, ...]:
+    # Hashable copy of expression, cheaper than str() for finding same ones
+    return tuple([x if type(x) is str else expr_key(x) for x in e])
 
 
 class Quad(Enum):
@@ -146,7 +254,53 @@ def bool_to_str10(lst: Sequence[bool]) -> str:
 
 
 def str10_to_bool(s: str) -> Sequence[bool]:
-    return tuple(a == "1" for a in s.split(" "))
+    return tuple(a == "1" for a in s.split(" ") if a)
+
+
+# Permissions are numbered per class. Bits 0..62 of permission mask go to
+# INTEGER column, higher bits for classes with more permissions to BLOB.
+permmask_bits = 63
+
+
+def bits_to_permmask(bits: Iterable[int]) -> Tuple[int, Optional[bytes]]:
+    mask = 0
+    for bit in bits:
+        mask |= 1 << bit
+    ext = mask >> permmask_bits
+    if not ext:
+        return mask, None
+    mask &= (1 << permmask_bits) - 1
+    return mask, ext.to_bytes((ext.bit_length() + 7) // 8, "little")
+
+
+def permmask_to_int(mask: int, ext: Optional[bytes]) -> int:
+    if not ext:
+        return mask
+    return mask | int.from_bytes(ext, "little") << permmask_bits
+
+
+def permmask_and(a: Optional[bytes], b: Optional[bytes]) -> Optional[bytes]:
+    # SQL function for BLOB part of permission masks
+    if not a or not b:
+        return None
+    res = int.from_bytes(a, "little") & int.from_bytes(b, "little")
+    if not res:
+        return None
+    return res.to_bytes((res.bit_length() + 7) // 8, "little")
+
+
+def bit_indexes(bits: int) -> Iterator[int]:
+    # Positions of set bits, lowest first
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def fingerprint(*parts: str) -> int:
+    # Same parts give same value in every cache, 64 bits fit INTEGER
+    digest = hashlib.sha256("\0".join(parts).encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
 
 
 def expr_to_str(
@@ -164,51 +318,227 @@ def expr_to_str(
     return " ".join(rstring)
 
 
-# type enforcement rule
-@dataclass(frozen=True)
-class TERule:
-    file: str
-    string: str
-    type: str
-    source: str
-    target: str
-    klass: str
-    perms: Sequence[str] = field(default_factory=list)
-    optional: Sequence[str] = field(default_factory=list)
-    booleanvalue: Sequence[bool] = field(default_factory=list)
-
-    def sqldict(self) -> Dict[str, str]:
+# Operators of typeattributeset expressions, see evaluate_logical_attributes
+logical_operators = ("and", "or", "xor", "not", "all")
+
+
+def expr_to_cil(e: Union[str, CilExpression]) -> str:
+    if isinstance(e, str):
+        return e
+    return "(" + " ".join(expr_to_cil(x) for x in e) + ")"
+
+
+T = TypeVar("T")
+
+
+class CacheTable(Dict[int, T]):
+    # Interned values of cache table, read and decoded by id when first used
+    __slots__ = ("con", "query", "decode")
+
+    def __init__(
+        self, con: sqlite3.Connection, query: str, decode: Callable[..., T]
+    ) -> None:
+        super().__init__()
+        self.con = con
+        self.query = query
+        self.decode = decode
+
+    def __missing__(self, idx: int) -> T:
+        # Own cursor, this may be called while iterating other query
+        res = self.con.execute(self.query, (idx,)).fetchone()
+        if res is None:
+            raise KeyError(idx)
+        value = self[idx] = self.decode(*res)
+        return value
+
+
+class CacheSymbols:
+    # Interned values of cache by id. Searches show only few of them, so
+    # each is read when first used instead of whole tables.
+    def __init__(self, con: sqlite3.Connection) -> None:
+        self.con = con
+        self.files = CacheTable(con, "SELECT file FROM files WHERE id = ?", str)
+        self.names = CacheTable(con, "SELECT name FROM names WHERE id = ?", str)
+        self.permsets = CacheTable(
+            con,
+            "SELECT perms FROM permsets WHERE id = ?",
+            lambda perms: perms.split(" "),
+        )
+        self.contexts = CacheTable(
+            con,
+            "SELECT optional, booleanvalue FROM contexts WHERE id = ?",
+            lambda optional, booleanvalue: (
+                json.loads(optional),
+                str10_to_bool(booleanvalue),
+            ),
+        )
+        self.name_ids: Dict[str, int] = {}
+
+    @functools.cached_property
+    def class_perms(self) -> DefaultDict[int, Dict[str, int]]:
+        res: DefaultDict[int, Dict[str, int]] = defaultdict(dict)
+        for klass, perm, bit in self.con.execute(
+            "SELECT class, perm, bit FROM class_perms"
+        ).fetchall():
+            res[klass][perm] = bit
+        return res
+
+    def permmask(
+        self, klass: str, perms: Iterable[str]
+    ) -> Tuple[int, Optional[bytes], Set[str]]:
+        # Mask of perms known for class, and perms not known at all
+        known = self.class_perms[self.id(klass)]
+        unknown = {p for p in perms if p not in known}
+        mask, ext = bits_to_permmask(known[p] for p in perms if p in known)
+        return mask, ext, unknown
+
+    def mask_perms(self, klass: str, mask: int) -> Set[str]:
         return {
-            "file": self.file,
-            "string": self.string,
-            "type": self.type,
-            "source": self.source,
-            "target": self.target,
-            "class": self.klass,
-            "perms": " ".join(self.perms),
-            "optional": " ".join(self.optional),
-            "booleanvalue": bool_to_str10(self.booleanvalue),
+            perm
+            for perm, bit in self.class_perms[self.id(klass)].items()
+            if mask >> bit & 1
         }
 
+    def ids(self, names: Iterable[str]) -> List[int]:
+        # Names not in cache can not match anything
+        return [i for i in map(self.id, names) if i >= 0]
+
+    def id(self, name: str) -> int:
+        if name not in self.name_ids:
+            res = self.con.execute(
+                "SELECT id FROM names WHERE name = ?", (name,)
+            ).fetchone()
+            self.name_ids[name] = -1 if res is None else res[0]
+        return self.name_ids[name]
+
+
+class Columns:
+    # Rows of one table as array per column instead of object per row.
+    # Columns without typecode are lists, they can have None and strings.
+    def __init__(self, typecodes: Dict[str, str]) -> None:
+        self.data: Dict[str, Any] = {
+            k: array(t) if t else [] for k, t in typecodes.items()
+        }
+        self.count = 0
+
+    def append(self, *values: Any) -> None:
+        for column, value in zip(self.data.values(), values):
+            column.append(value)
+        self.count += 1
+
     @classmethod
-    def fromsqlrow(cls, res: sqlite3.Row) -> "TERule":
-        return TERule(
-            res["file"],
-            res["string"],
-            res["type"],
-            res["source"],
-            res["target"],
-            res["class"],
-            res["perms"].split(" "),
-            res["optional"].split(" "),
-            str10_to_bool(res["booleanvalue"]),
+    def frombuffers(cls, data: Dict[str, Any], count: int) -> "Columns":
+        # Columns of memory mapped file, see PolicyIndex
+        res = cls({})
+        res.data = data
+        res.count = count
+        return res
+
+    def __len__(self) -> int:
+        return self.count
+
+    def rows(self) -> Iterator["ColumnRow"]:
+        return (ColumnRow(self, idx) for idx in range(self.count))
+
+
+class ColumnRow:
+    # Row of Columns, views read it like sqlite3.Row
+    __slots__ = ("columns", "idx")
+
+    def __init__(self, columns: Columns, idx: int) -> None:
+        self.columns = columns
+        self.idx = idx
+
+    def __getitem__(self, key: str) -> Any:
+        return self.columns.data[key][self.idx]
+
+
+class RuleStore:
+    # Rules of one parsed file in Columns of ids to values interned here.
+    # Fields are same as in CacheSymbols, so that same views work for
+    # these and cached rows. Workers of --jobs send this as is.
+    def __init__(self, file: str) -> None:
+        self.files = [file]
+        self.names: List[str] = []
+        self.permsets: List[List[str]] = []
+        self.contexts: List[Tuple[List[str], List[bool]]] = []
+        self.ids: Dict[Any, int] = {}
+        self.te_rules = Columns(
+            {
+                "file": "i",
+                "type": "i",
+                "source": "i",
+                "target": "i",
+                "class": "i",
+                "perms": "i",
+                "context": "i",
+            }
+        )
+        # attrs is "," joined ids like taset_attrs_column of cache, and
+        # expression logical expression as JSON
+        self.typeattributes = Columns(
+            {
+                "file": "i",
+                "string": "",
+                "type": "i",
+                "attrs": "",
+                "expression": "",
+                "is_logical": "b",
+                "context": "i",
+            }
         )
+        # Declarations of types and attributes
+        self.types = Columns({"file": "i", "type": "i", "is_attribute": "b"})
+        self.typetransitions = Columns(
+            {
+                "file": "i",
+                "subject": "i",
+                "source": "i",
+                "class": "i",
+                "target": "i",
+                "filename": "",
+                "context": "i",
+            }
+        )
+        # Tables of labeling_tables, rule is statement as CIL for --from
+        self.labels = {
+            table: Columns(
+                {
+                    "file": "i",
+                    **{c: "" for c in columns},
+                    "value": "",
+                    "string": "",
+                    "context": "i",
+                    "rule": "",
+                }
+            )
+            for table, columns in labeling_tables.items()
+        }
 
-    @classmethod
-    def fromexpr(
-        cls, e: CilExpression, file: str, optional: List[str], booleanvalue: List[bool]
-    ) -> "TERule":
-        # Do first full assert of the type and then create Rule
+    def intern(self, values: List[Any], key: Any, value: Any) -> int:
+        idx = self.ids.get(key)
+        if idx is None:
+            idx = self.ids[key] = len(values)
+            values.append(value)
+        return idx
+
+    def name(self, name: str) -> int:
+        return self.intern(self.names, name, name)
+
+    def permset(self, perms: List[str]) -> int:
+        # Copy of names, list and strings of parse tree are not kept
+        idx = self.ids.get(("perms", *perms))
+        if idx is None:
+            names = [self.names[self.name(p)] for p in perms]
+            idx = self.intern(self.permsets, ("perms", *names), names)
+        return idx
+
+    def context(self, optional: List[str], booleanvalue: List[bool]) -> int:
+        key = ("context", tuple(optional), tuple(booleanvalue))
+        return self.intern(self.contexts, key, (optional, booleanvalue))
+
+    def add_te_rule(self, e: CilExpression, context: int) -> None:
+        # Do first full assert of the type and then add rule
         assert isinstance(e, list)
         assert len(e) == 4
         assert isinstance(e[0], str)
@@ -219,135 +549,658 @@ class TERule:
         assert isinstance(e[3][1], list)
         for _ in e[3][1]:
             assert isinstance(_, str)
-        rstring = expr_to_str(e, optional, booleanvalue)
-        return TERule(
-            file, rstring, e[0], e[1], e[2], e[3][0], e[3][1], optional, booleanvalue
+        self.te_rules.append(
+            0,
+            self.name(e[0]),
+            self.name(e[1]),
+            self.name(e[2]),
+            self.name(e[3][0]),
+            self.permset(e[3][1]),
+            context,
+        )
+
+    def add_taset(self, e: CilExpression, context: int) -> None:
+        assert isinstance(e, Sequence)
+        assert len(e) == 3
+        assert isinstance(e[0], str)
+        assert isinstance(e[1], str)
+        assert isinstance(e[2], Sequence)
+        rstring = expr_to_str(e, *self.contexts[context])
+        attrs = ""
+        expression = None
+        is_logical = e[2][0] in logical_operators
+        if not is_logical:
+            for _ in e[2]:
+                assert isinstance(_, str)
+            attrs = ",".join(str(self.name(a)) for a in sorted(set(e[2])))
+        else:
+            expression = json.dumps(e[2])
+        self.typeattributes.append(
+            0, rstring, self.name(e[1]), attrs, expression, is_logical, context
         )
 
+    def add_type(self, e: CilExpression) -> None:
+        assert isinstance(e, Sequence)
+        assert len(e) == 2
+        assert isinstance(e[1], str)
+        self.types.append(0, self.name(e[1]), e[0] == "typeattribute")
 
-# type attribute set
-@dataclass(frozen=True)
-class TASet:
-    file: str
-    string: str
-    type: str
-    attrs: FrozenSet[str] = field(default_factory=FrozenSet)
-    is_logical: bool = False
-    optional: Sequence[str] = field(default_factory=Sequence)
-    booleanvalue: Sequence[bool] = field(default_factory=Sequence)
-
-    def sqldict(self) -> Dict[str, Union[str, bool]]:
+    def add_typetransition(self, e: CilExpression, context: int) -> None:
+        assert isinstance(e, list)
+        assert len(e) >= 5
+        assert isinstance(e[0], str)
+        assert isinstance(e[1], str)
+        assert isinstance(e[2], str)
+        assert isinstance(e[3], str)
+        assert isinstance(e[4], str)
+        target, filename = e[4], None
+        if len(e) == 6:
+            assert isinstance(e[5], str)
+            target, filename = e[5], self.name(e[4])
+        self.typetransitions.append(
+            0,
+            self.name(e[1]),
+            self.name(e[2]),
+            self.name(e[3]),
+            self.name(target),
+            filename,
+            context,
+        )
+
+    def add_label(self, e: CilExpression, context: int) -> None:
+        table, key, value = labeling_row(e)
+        self.labels[table].append(
+            0,
+            *key,
+            value,
+            expr_to_str(e, *self.contexts[context]),
+            context,
+            expr_to_cil(e),
+        )
+
+
+class IndexTable(Generic[T]):
+    # Strings of PolicyIndex as offsets and UTF-8 data, decoded when used
+    __slots__ = ("offsets", "data", "decode")
+
+    def __init__(
+        self, offsets: memoryview, data: memoryview, decode: Callable[[str], T]
+    ) -> None:
+        self.offsets = offsets
+        self.data = data
+        self.decode = decode
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def raw(self, idx: int) -> bytes:
+        return bytes(self.data[self.offsets[idx] : self.offsets[idx + 1]])
+
+    def __getitem__(self, idx: int) -> T:
+        data = self.data[self.offsets[idx] : self.offsets[idx + 1]]
+        return self.decode(str(data, "utf-8"))
+
+    def find(self, value: str) -> int:
+        # Binary search of sorted table, -1 if not found
+        key = value.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self.raw(lo) == key else -1
+
+
+# Columns of rule tables in PolicyIndex and tables their ids refer to
+policy_index_columns = {
+    "te_rules": {
+        "file": "files",
+        "type": "names",
+        "source": "names",
+        "target": "names",
+        "class": "names",
+        "perms": "permsets",
+        "context": "contexts",
+    },
+}
+# Rule columns having sorted copy in index
+policy_index_keys = ("source", "target", "class")
+policy_index_magic = b"CILIDX01"
+
+
+class PolicyIndex:
+    # Read-only copy of cache written by --export-index and mapped to
+    # memory. Arrays are used in place, so processes searching it share
+    # same pages. Ids are positions in tables of index, names are sorted
+    # for binary search. Fields are same as in CacheSymbols for views.
+    #
+    # File is magic, length of JSON header, header and sections aligned
+    # to 8 bytes. Header has offsets, typecodes and lengths of sections:
+    #   {table}.offsets, {table}.data: names, files, permsets, contexts
+    #   {table}.{column}: columns of te_rules
+    #   {table}.by_{column}.keys/rows: column sorted, and rows in that order
+    #   attributes/members.offsets/values: attribute_closure both ways
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.mm)
+        if bytes(buf[:8]) != policy_index_magic:
+            raise ValueError("not a policy index")
+        size = int.from_bytes(buf[8:16], "little")
+        header = json.loads(bytes(buf[16 : 16 + size]))
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("policy index of other byte order")
+        base = (16 + size + 7) // 8 * 8
+        self.key: List[Any] = header["key"]
+        self.sections: Dict[str, memoryview] = {}
+        for name, (offset, typecode, count) in header["sections"].items():
+            start = base + offset
+            section = buf[start : start + count * array(typecode).itemsize]
+            self.sections[name] = section.cast(typecode)
+
+        self.names = self.table("names", str)
+        self.files = self.table("files", str)
+        self.permsets = self.table("permsets", lambda s: s.split(" "))
+        self.contexts = self.table("contexts", self.decode_context)
+        self.tables: Dict[str, Columns] = {}
+        for table, columns in policy_index_columns.items():
+            data: Dict[str, Any] = {c: self.sections[f"{table}.{c}"] for c in columns}
+            self.tables[table] = Columns.frombuffers(data, len(data["file"]))
+
+    def table(self, name: str, decode: Callable[[str], T]) -> IndexTable[T]:
+        return IndexTable(
+            self.sections[f"{name}.offsets"], self.sections[f"{name}.data"], decode
+        )
+
+    @staticmethod
+    def decode_context(s: str) -> Tuple[List[str], Sequence[bool]]:
+        booleanvalue, optional = s.split("\t", 1)
+        return json.loads(optional), str10_to_bool(booleanvalue)
+
+    def attribute_closure(self, column: str, ids: Iterable[int]) -> Set[int]:
+        # Same as CilSearcher.attribute_closure
+        assert column in ("member", "attribute")
+        name = "attributes" if column == "member" else "members"
+        offsets = self.sections[f"{name}.offsets"]
+        values = self.sections[f"{name}.values"]
+        res: Set[int] = set()
+        for i in ids:
+            res.update(values[offsets[i] : offsets[i + 1]].tolist())
+        return res
+
+    def select(
+        self,
+        table: str,
+        wanted: Dict[str, Set[int]],
+        unwanted: Dict[str, Set[int]],
+        perms: Optional[Set[str]],
+    ) -> List[int]:
+        # Rows having one of wanted ids in each column, none of unwanted
+        # ones and any of perms, in rowid order. Candidates come from
+        # sorted column giving fewest of them, rest is checked per row.
+        columns = self.tables[table]
+        best: Optional[Tuple[int, str, List[Tuple[int, int]]]] = None
+        for column, ids in wanted.items():
+            if column not in policy_index_keys:
+                continue
+            keys = self.sections[f"{table}.by_{column}.keys"]
+            ranges = [
+                (bisect.bisect_left(keys, i), bisect.bisect_right(keys, i)) for i in ids
+            ]
+            size = sum(hi - lo for lo, hi in ranges)
+            if best is None or size < best[0]:
+                best = (size, column, ranges)
+        rows: Iterable[int] = range(len(columns))
+        if best is not None:
+            order = self.sections[f"{table}.by_{best[1]}.rows"]
+            rows = sorted(i for lo, hi in best[2] for i in order[lo:hi].tolist())
+
+        checks = [(columns.data[c], ids, True) for c, ids in wanted.items()]
+        checks.extend((columns.data[c], ids, False) for c, ids in unwanted.items())
+        has_perms: Dict[int, bool] = {}
+        res = []
+        for idx in rows:
+            if not all((col[idx] in ids) == want for col, ids, want in checks):
+                continue
+            if perms is not None:
+                p = columns.data["perms"][idx]
+                if p not in has_perms:
+                    has_perms[p] = not perms.isdisjoint(self.permsets[p])
+                if not has_perms[p]:
+                    continue
+            res.append(idx)
+        return res
+
+    @staticmethod
+    def strings(values: Iterable[str]) -> Tuple["array[int]", "array[int]"]:
+        offsets = array("q", [0])
+        data = bytearray()
+        for value in values:
+            data += value.encode()
+            offsets.append(len(data))
+        return offsets, array("B", data)
+
+    @staticmethod
+    def adjacency(
+        pairs: Iterable[Tuple[int, int]], count: int
+    ) -> Tuple["array[int]", "array[int]"]:
+        # Values of each key in same form as strings
+        pairs = sorted(pairs)
+        offsets = array("q", [0]) * (count + 1)
+        for key, _ in pairs:
+            offsets[key + 1] += 1
+        for i in range(count):
+            offsets[i + 1] += offsets[i]
+        return offsets, array("i", [value for _, value in pairs])
+
+    @staticmethod
+    def write(path: str, key: List[Any], sections: Dict[str, "array[int]"]) -> None:
+        directory = {}
+        offset = 0
+        for name, values in sections.items():
+            directory[name] = [offset, values.typecode, len(values)]
+            offset += (len(values) * values.itemsize + 7) // 8 * 8
+        header = json.dumps(
+            {"key": key, "byteorder": sys.byteorder, "sections": directory}
+        ).encode()
+        # New file is renamed over old one, processes having old one
+        # mapped keep using it.
+        tmp = f"{path}.{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(policy_index_magic)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            f.write(bytes(-(16 + len(header)) % 8))
+            for values in sections.values():
+                values.tofile(f)
+                f.write(bytes(-(len(values) * values.itemsize) % 8))
+        os.replace(tmp, path)
+
+
+Symbols = Union[CacheSymbols, RuleStore, PolicyIndex]
+
+
+# Views of cached and parsed rows. Fields are decoded from interned ids only
+# when used.
+# Columns which together give file and string of row.
+te_rules_key_columns = ("file", "type", "source", "target", "class", "perms", "context")
+typetransitions_key_columns = (
+    "file",
+    "subject",
+    "source",
+    "class",
+    "target",
+    "filename",
+    "context",
+)
+
+
+class TERuleView:
+    __slots__ = ("res", "symbols")
+
+    def __init__(self, res: Union[sqlite3.Row, ColumnRow], symbols: Symbols) -> None:
+        self.res = res
+        self.symbols = symbols
+
+    @property
+    def file(self) -> str:
+        return self.symbols.files[self.res["file"]]
+
+    @property
+    def type(self) -> str:
+        return self.symbols.names[self.res["type"]]
+
+    @property
+    def source(self) -> str:
+        return self.symbols.names[self.res["source"]]
+
+    @property
+    def target(self) -> str:
+        return self.symbols.names[self.res["target"]]
+
+    @property
+    def klass(self) -> str:
+        return self.symbols.names[self.res["class"]]
+
+    @property
+    def perms(self) -> List[str]:
+        return self.symbols.permsets[self.res["perms"]]
+
+    @property
+    def optional(self) -> List[str]:
+        return self.symbols.contexts[self.res["context"]][0]
+
+    @property
+    def booleanvalue(self) -> Sequence[bool]:
+        return self.symbols.contexts[self.res["context"]][1]
+
+    @property
+    def key(self) -> Tuple[Any, ...]:
+        # Same as file and string, but without decoding anything
+        return ("te_rules", *(self.res[k] for k in te_rules_key_columns))
+
+    @property
+    def string(self) -> str:
+        e: CilExpression = [
+            self.type,
+            self.source,
+            self.target,
+            [self.klass, list(self.perms)],
+        ]
+        return expr_to_str(e, self.optional, self.booleanvalue)
+
+    def record(self) -> Dict[str, Any]:
         return {
+            "kind": "te_rules",
             "file": self.file,
+            "type": self.type,
+            "source": self.source,
+            "target": self.target,
+            "class": self.klass,
+            "perms": self.perms,
+            "optional": self.optional,
+            "booleanvalue": list(self.booleanvalue),
             "string": self.string,
+        }
+
+
+class TASetView:
+    __slots__ = ("res", "symbols")
+
+    def __init__(self, res: Union[sqlite3.Row, ColumnRow], symbols: Symbols) -> None:
+        self.res = res
+        self.symbols = symbols
+
+    @property
+    def file(self) -> str:
+        return self.symbols.files[self.res["file"]]
+
+    @property
+    def string(self) -> str:
+        string: str = self.res["string"]
+        return string
+
+    @property
+    def key(self) -> Tuple[Any, ...]:
+        return ("typeattributes", self.res["file"], self.string)
+
+    @property
+    def type(self) -> str:
+        return self.symbols.names[self.res["type"]]
+
+    @property
+    def attrs(self) -> FrozenSet[str]:
+        if not self.res["attrs"]:
+            return frozenset()
+        return frozenset(
+            self.symbols.names[int(a)] for a in self.res["attrs"].split(",")
+        )
+
+    @property
+    def is_logical(self) -> bool:
+        return bool(self.res["is_logical"])
+
+    @property
+    def expression(self) -> Optional[CilExpression]:
+        if self.res["expression"] is None:
+            return None
+        e: CilExpression = json.loads(self.res["expression"])
+        return e
+
+    @property
+    def optional(self) -> List[str]:
+        return self.symbols.contexts[self.res["context"]][0]
+
+    @property
+    def booleanvalue(self) -> Sequence[bool]:
+        return self.symbols.contexts[self.res["context"]][1]
+
+    def record(self) -> Dict[str, Any]:
+        return {
+            "kind": "typeattributes",
+            "file": self.file,
             "type": self.type,
-            "attrs": " ".join(sorted(self.attrs)),
+            "attrs": sorted(self.attrs),
             "is_logical": self.is_logical,
-            "optional": " ".join(self.optional),
-            "booleanvalue": bool_to_str10(self.booleanvalue),
+            "optional": self.optional,
+            "booleanvalue": list(self.booleanvalue),
+            "string": self.string,
         }
 
-    @classmethod
-    def fromsqlrow(cls, res: sqlite3.Row) -> "TASet":
-        return TASet(
-            res["file"],
-            res["string"],
-            res["type"],
-            frozenset(res["attrs"].split(" ")),
-            res["is_logical"],
-            tuple(res["optional"].split(" ")),
-            str10_to_bool(res["booleanvalue"]),
-        )
 
-    @classmethod
-    def fromexpr(
-        cls,
-        e: CilExpression,
-        file: str,
-        optional: Sequence[str],
-        booleanvalue: Sequence[bool],
-    ) -> "TASet":
-        assert isinstance(e, Sequence)
-        assert len(e) == 3
-        assert isinstance(e[0], str)
-        assert isinstance(e[1], str)
-        assert isinstance(e[2], Sequence)
-        rstring = expr_to_str(e, optional, booleanvalue)
-        if e[2][0] in ("and", "not", "or"):
-            return TASet(file, rstring, e[1], frozenset(), True, optional, booleanvalue)
-        for _ in e[2]:
-            assert isinstance(_, str)
-        return TASet(
-            file, rstring, e[1], frozenset(e[2]), False, optional, booleanvalue
+class TypetransitionView:
+    __slots__ = ("res", "symbols")
+
+    def __init__(self, res: Union[sqlite3.Row, ColumnRow], symbols: Symbols) -> None:
+        self.res = res
+        self.symbols = symbols
+
+    @property
+    def file(self) -> str:
+        return self.symbols.files[self.res["file"]]
+
+    @property
+    def subject(self) -> str:
+        return self.symbols.names[self.res["subject"]]
+
+    @property
+    def source(self) -> str:
+        return self.symbols.names[self.res["source"]]
+
+    @property
+    def klass(self) -> str:
+        return self.symbols.names[self.res["class"]]
+
+    @property
+    def target(self) -> str:
+        return self.symbols.names[self.res["target"]]
+
+    @property
+    def filename(self) -> Optional[str]:
+        if self.res["filename"] is None:
+            return None
+        return self.symbols.names[self.res["filename"]]
+
+    @property
+    def optional(self) -> List[str]:
+        return self.symbols.contexts[self.res["context"]][0]
+
+    @property
+    def booleanvalue(self) -> Sequence[bool]:
+        return self.symbols.contexts[self.res["context"]][1]
+
+    @property
+    def key(self) -> Tuple[Any, ...]:
+        return (
+            "typetransitions",
+            *(self.res[k] for k in typetransitions_key_columns),
         )
 
+    @property
+    def string(self) -> str:
+        e: CilExpression = ["typetransition", self.subject, self.source, self.klass]
+        if self.filename is not None:
+            e.append(self.filename)
+        e.append(self.target)
+        return expr_to_str(e, self.optional, self.booleanvalue)
 
-@dataclass(frozen=True)
-class Typetransition:
-    file: str
-    string: str
-    subject: str
-    source: str
-    klass: str
-    target: str
-    filename: Optional[str] = None
-    optional: Sequence[str] = field(default_factory=list)
-    booleanvalue: Sequence[bool] = field(default_factory=list)
-
-    def sqldict(self) -> Dict[str, Optional[str]]:
+    def record(self) -> Dict[str, Any]:
         return {
+            "kind": "typetransitions",
             "file": self.file,
-            "string": self.string,
             "subject": self.subject,
             "source": self.source,
             "class": self.klass,
             "target": self.target,
             "filename": self.filename,
-            "optional": " ".join(self.optional),
-            "booleanvalue": bool_to_str10(self.booleanvalue),
+            "optional": self.optional,
+            "booleanvalue": list(self.booleanvalue),
+            "string": self.string,
         }
 
-    @classmethod
-    def fromsqlrow(cls, res: sqlite3.Row) -> "Typetransition":
-        return Typetransition(
-            res["file"],
-            res["string"],
-            res["subject"],
-            res["source"],
-            res["class"],
-            res["target"],
-            res["filename"],
-            res["optional"].split(" "),
-            str10_to_bool(res["booleanvalue"]),
-        )
 
-    @classmethod
-    def fromexpr(
-        cls,
-        e: CilExpression,
-        file: str,
-        optional: Sequence[str],
-        booleanvalue: Sequence[bool],
-    ) -> "Typetransition":
-        assert isinstance(e, list)
-        assert len(e) >= 5
-        assert isinstance(e[0], str)
-        assert isinstance(e[1], str)
-        assert isinstance(e[2], str)
-        assert isinstance(e[3], str)
-        assert isinstance(e[4], str)
-        rstring = expr_to_str(e, optional, booleanvalue)
-        if len(e) == 6:
-            assert isinstance(e[5], str)
-            return Typetransition(
-                file, rstring, e[1], e[2], e[3], e[5], e[4], optional, booleanvalue
-            )
-        return Typetransition(
-            file, rstring, e[1], e[2], e[3], e[4], None, optional, booleanvalue
+class LabelView:
+    # Row of one of labeling_tables
+    __slots__ = ("res", "symbols", "table")
+
+    def __init__(
+        self, res: Union[sqlite3.Row, ColumnRow], symbols: Symbols, table: str
+    ) -> None:
+        self.res = res
+        self.symbols = symbols
+        self.table = table
+
+    @property
+    def file(self) -> str:
+        return self.symbols.files[self.res["file"]]
+
+    @property
+    def labeled(self) -> Tuple[Any, ...]:
+        return tuple(self.res[c] for c in labeling_tables[self.table])
+
+    @property
+    def value(self) -> str:
+        value: str = self.res["value"]
+        return value
+
+    @property
+    def string(self) -> str:
+        string: str = self.res["string"]
+        return string
+
+    @property
+    def key(self) -> Tuple[Any, ...]:
+        return (self.table, self.res["file"], self.string)
+
+    @property
+    def optional(self) -> List[str]:
+        return self.symbols.contexts[self.res["context"]][0]
+
+    @property
+    def booleanvalue(self) -> Sequence[bool]:
+        return self.symbols.contexts[self.res["context"]][1]
+
+    def record(self) -> Dict[str, Any]:
+        return {
+            "kind": self.table,
+            "file": self.file,
+            **dict(zip(labeling_tables[self.table], self.labeled)),
+            "value": self.value,
+            "optional": self.optional,
+            "booleanvalue": list(self.booleanvalue),
+            "string": self.string,
+        }
+
+
+RuleView = Union[TERuleView, TASetView, TypetransitionView, LabelView]
+
+
+class Stats:
+    # Timings and counters of --stats, written as one JSON line at end.
+    # Target "-" is stderr, None disables. Phases may be inside each other,
+    # their times include inner ones.
+    def __init__(self, target: Optional[str]) -> None:
+        self.target = target
+        self.start = time.perf_counter()
+        self.seconds: DefaultDict[str, float] = defaultdict(float)
+        self.calls: DefaultDict[str, int] = defaultdict(int)
+        self.counters: DefaultDict[str, int] = defaultdict(int)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        if self.target is not None:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.target is not None:
+            self.counters[name] += n
+
+    def counted(self, name: str, rows: Iterable[T]) -> Iterable[T]:
+        # Rows read from query, compare to rows_returned
+        if self.target is None:
+            return rows
+        return self.count_rows(f"{name}.rows_fetched", rows)
+
+    def count_rows(self, name: str, rows: Iterable[T]) -> Iterator[T]:
+        n = 0
+        try:
+            for res in rows:
+                n += 1
+                yield res
+        finally:
+            self.counters[name] += n
+
+    def trace(self, statement: str) -> None:
+        # sqlite3 trace callback
+        self.counters["sql_statements"] += 1
+        if statement.lstrip().upper().startswith("CREATE TEMPORARY TABLE"):
+            self.counters["temp_tables"] += 1
+
+    def report(self) -> None:
+        if self.target is None:
+            return
+        line = json.dumps(
+            {
+                "pid": os.getpid(),
+                "seconds": time.perf_counter() - self.start,
+                "phases": {
+                    k: {"seconds": v, "calls": self.calls[k]}
+                    for k, v in sorted(self.seconds.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
         )
+        if self.target == "-":
+            print(line, file=sys.stderr)
+            return
+        # One write, so that lines of parallel processes are not mixed
+        with open(self.target, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class ResultWriter:
+    # Search output is collected here and written to stdout in chunks.
+    # With --format jsonl each line is JSON object: rows have their
+    # decoded fields and kind, other lines have what text has after "#".
+    def __init__(self, fmt: str, stats: Stats) -> None:
+        self.jsonl = fmt == "jsonl"
+        self.stats = stats
+        self.buf: List[str] = []
+        self.size = 0
+
+    def row(self, r: RuleView) -> None:
+        self.stats.count(f"{r.key[0]}.rows_returned")
+        if self.jsonl:
+            self.write(json.dumps(r.record()))
+        else:
+            self.write(f"{r.file}:{r.string}")
+
+    def line(self, text: str, record: Dict[str, Any]) -> None:
+        self.write(json.dumps(record) if self.jsonl else text)
 
+    def write(self, line: str) -> None:
+        self.buf.append(line)
+        self.size += len(line) + 1
+        if self.size > 65536:
+            self.flush()
 
-cilp = CilParser()
+    def flush(self) -> None:
+        if self.buf:
+            self.buf.append("")
+            with self.stats.phase("output"):
+                sys.stdout.write("\n".join(self.buf))
+            self.buf = []
+            self.size = 0
 
 
 type_enforcement_rule_types = [
@@ -362,19 +1215,186 @@ type_enforcement_rule_types = [
 ]
 
 
+# Labeling statements, where SELinux does not allow same thing labeled
+# twice. Each has own table with key columns telling what is labeled and
+# their SQL types. Rest of statement is value it is labeled with, same key
+# with other value is conflict. Ports conflict when ranges overlap.
+labeling_tables = {
+    "filecons": {"path": "TEXT", "filetype": "TEXT"},
+    "genfscons": {"fs": "TEXT", "path": "TEXT", "filetype": "TEXT"},
+    "portcons": {"protocol": "TEXT", "low": "INTEGER", "high": "INTEGER"},
+    "fsuses": {"fs": "TEXT"},
+    "sidcontexts": {"sid": "TEXT"},
+    "selinuxusers": {"name": "TEXT"},
+}
+labeling_statement_types = frozenset(
+    [
+        "filecon",
+        "fsuse",
+        "genfscon",
+        "portcon",
+        "selinuxuser",
+        "selinuxuserdefault",
+        "sidcontext",
+    ]
+)
+
+
+def labeling_row(e: CilExpression) -> Tuple[str, Tuple[Any, ...], str]:
+    # Table, key and value of labeling statement
+    assert isinstance(e[0], str)
+    for _ in e[1:-1]:
+        assert isinstance(_, (str, list))
+    if e[0] == "filecon":
+        # ['filecon', '"path"', 'filetype', context]
+        assert len(e) == 4
+        return "filecons", (e[1], e[2]), str(e[3])
+    if e[0] == "genfscon":
+        # ['genfscon', 'fs', 'path', context], file type is optional
+        assert len(e) in (4, 5)
+        return "genfscons", (e[1], e[2], e[3] if len(e) == 5 else None), str(e[-1])
+    if e[0] == "portcon":
+        # ['portcon', 'protocol', 'port' or ['low', 'high'], context]
+        assert len(e) == 4
+        low, high = (e[2], e[2]) if isinstance(e[2], str) else e[2]
+        return "portcons", (e[1], int(low), int(high)), str(e[3])
+    if e[0] == "fsuse":
+        # ['fsuse', 'behavior', 'fs', context]
+        assert len(e) == 4
+        return "fsuses", (e[2],), f"{e[1]} {e[3]}"
+    if e[0] == "sidcontext":
+        # ['sidcontext', 'sid', context]
+        assert len(e) == 3
+        return "sidcontexts", (e[1],), str(e[2])
+    if e[0] == "selinuxuser":
+        # ['selinuxuser', 'name', 'user', range]
+        assert len(e) == 4
+        return "selinuxusers", (e[1],), f"{e[2]} {e[3]}"
+    # ['selinuxuserdefault', 'user', range] is user of __default__
+    assert e[0] == "selinuxuserdefault"
+    assert len(e) == 3
+    return "selinuxusers", ("__default__",), f"{e[1]} {e[2]}"
+
+
+# Statements not used for anything
+ignored_statement_types = frozenset(
+    [
+        "allowx",
+        "category",
+        "categoryorder",
+        "class",
+        "classcommon",
+        "classorder",
+        "common",
+        "defaultrange",
+        "handleunknown",
+        "mls",
+        "mlsconstrain",
+        "policycap",
+        "rangetransition",
+        "role",
+        "roleallow",
+        "roleattribute",
+        "roleattributeset",
+        "roletransition",
+        "roletype",
+        "sensitivity",
+        "sensitivitycategory",
+        "sensitivityorder",
+        "sid",
+        "sidorder",
+        "typealias",
+        "typealiasactual",
+        "typechange",
+        "typemember",
+        "typepermissive",
+        "user",
+        "userlevel",
+        "userprefix",
+        "userrange",
+        "userrole",
+    ]
+)
+
+
+# Increase when tables change, cache is then rebuilt
+cache_schema_version = 12
+cache_file = "export/cache.db"
+policy_index_file = "export/cache.idx"
+# Members of typeattributes row for TASetView
+taset_attrs_column = """( SELECT group_concat(member) FROM typeattribute_members
+    WHERE typeattribute = typeattributes.id ) AS attrs"""
+
+cache_indexes = [
+    ("files_digest", "files", ("digest",)),
+    ("files_fingerprint", "files", ("fingerprint",)),
+    ("te_rules_fingerprint", "te_rules", ("fingerprint",)),
+    ("typeattributes_fingerprint", "typeattributes", ("fingerprint",)),
+    ("typetransitions_fingerprint", "typetransitions", ("fingerprint",)),
+    ("te_rules_file", "te_rules", ("file",)),
+    ("te_rules_source", "te_rules", ("source", "target", "class", "type")),
+    ("te_rules_target", "te_rules", ("target", "class", "type")),
+    ("typeattributes_file", "typeattributes", ("file",)),
+    ("typeattributes_type", "typeattributes", ("type",)),
+    ("types_file", "types", ("file",)),
+    (
+        "typeattribute_members_typeattribute",
+        "typeattribute_members",
+        ("typeattribute",),
+    ),
+    ("typeattribute_members_member", "typeattribute_members", ("member",)),
+    ("attribute_closure_attribute", "attribute_closure", ("attribute", "member")),
+    ("typetransitions_file", "typetransitions", ("file",)),
+    (
+        "typetransitions_subject",
+        "typetransitions",
+        ("subject", "source", "class", "target", "filename"),
+    ),
+] + [
+    (f"{table}_{name}", table, columns)
+    for table, key in labeling_tables.items()
+    for name, columns in (
+        ("file", ("file",)),
+        ("fingerprint", ("fingerprint",)),
+        ("key", tuple(key)),
+    )
+]
+
+
 class CilSearcher:
     def __init__(self, args: argparse.Namespace) -> None:
-        self.tasets: DefaultDict[str, List[TASet]] = defaultdict(list)
-        self.reverse_tasets: DefaultDict[str, List[TASet]] = defaultdict(list)
-        self.typetransitions: List[Typetransition] = []
-        self.cil_from: Optional[ParsedCil] = None
-        self.args = args
-        self.update_args()
+        self.typetransitions: List[TypetransitionView] = []
         self.con: Optional[sqlite3.Connection] = None
         self.cur: Optional[sqlite3.Cursor] = None
+        self.write_con: Optional[sqlite3.Connection] = None
+        self.write_cur: Optional[sqlite3.Cursor] = None
+        self.symbols: Optional[CacheSymbols] = None
+        self.index: Optional[PolicyIndex] = None
+        self.generation: Optional[Tuple[str, int]] = None
+        self.known_files: Optional[List[str]] = None
+        self.known_dirs: Dict[str, Optional[int]] = {}
         self.files: List[str] = []
+        self.searched_files: Optional[List[str]] = None
+        self.files_table: Optional[str] = None
+        self.membership_table: Optional[str] = None
+        self.interned: Dict[Tuple[str, ...], int] = {}
+        self.set_args(args)
 
-    def update_args(self) -> None:
+    def set_args(self, args: argparse.Namespace) -> None:
+        # Searcher can be used for many searches, see CilServer
+        self.args = args
+        self.from_file: Optional[str] = None
+        self.cil_from: Optional[RuleStore] = None
+        stats = args.stats_file or ("-" if args.stats else None)
+        if stats is None:
+            stats = os.environ.get("SIMPLE_CIL_PARSER_STATS") or None
+        self.stats = Stats("-" if stats == "1" else stats)
+        self.out = ResultWriter(args.format, self.stats)
+        self.update_args()
+
+    def update_args(self, expand: bool = False) -> None:
+        # Types are expanded through attributes only with expand, which
+        # needs cache loaded
         self.oargs = vars(self.args)
         self.vargs: DefaultDict[str, Set[str]] = defaultdict(set)
         for key in ("perms",):
@@ -398,333 +1418,1270 @@ class CilSearcher:
                 vals.add(self.oargs[key])
             else:
                 vals.update(self.oargs[key])
-            self.vargs[key].update(vals)
-            for val in vals:
-                for r in self.reverse_tasets[val]:
-                    self.vargs[key].add(r.type)
+            self.vargs[key].update(self.expand_attrs(vals) if expand else vals)
 
-    def setup_cache(self) -> None:
-        con = sqlite3.connect("export/cache.db", timeout=3600)
+    def expand_attrs(self, vals: Set[str]) -> Set[str]:
+        # Type and all attributes of searched files it belongs to, also
+        # through nested ones
+        res = set(vals)
+        if self.symbols is not None:
+            res.update(
+                self.symbols.names[a]
+                for a in self.attribute_closure("member", self.symbols.ids(vals))
+            )
+        return res
+
+    def connect(self, mode: str) -> sqlite3.Connection:
+        # CilServer uses searcher only from one thread at time, but not
+        # always from same one.
+        con = sqlite3.connect(
+            f"file:{cache_file}?mode={mode}",
+            uri=True,
+            timeout=3600,
+            check_same_thread=False,
+        )
         # con.enable_callback_tracebacks(print)
         con.row_factory = sqlite3.Row
+        con.create_function("permmask_and", 2, permmask_and, deterministic=True)
+        con.set_trace_callback(
+            self.stats.trace if self.stats.target is not None else None
+        )
+        return con
+
+    def setup_cache(self) -> None:
+        # Searches use read only connection. Cache is in WAL mode, so
+        # readers never wait for writer or each other, and schema is
+        # written only when it is not current.
+        try:
+            con = self.connect("ro")
+        except sqlite3.OperationalError:
+            # No cache yet
+            self.create_cache()
+            con = self.connect("ro")
         cur = con.cursor()
+        cur.execute("PRAGMA user_version")
+        ready = cur.fetchone()[0] == cache_schema_version
+        cur.execute("PRAGMA journal_mode")
+        if not ready or cur.fetchone()[0] != "wal":
+            con.close()
+            self.create_cache()
+            con = self.connect("ro")
+        self.cur = con.cursor()
+        self.con = con
+
+    def open_writer(self) -> None:
+        # Only refresh writes to cache
+        if self.write_con is None:
+            self.write_con = self.connect("rwc")
+            # Cache can be built again, commits need not wait for disk
+            self.write_con.execute("PRAGMA synchronous = NORMAL")
+            self.write_cur = self.write_con.cursor()
+
+    def create_cache(self) -> None:
+        self.open_writer()
+        assert self.write_con is not None
+        assert self.write_cur is not None
+        con = self.write_con
+        cur = self.write_cur
+        # Needs to be set outside of transaction, it is kept in database
+        cur.execute("PRAGMA journal_mode = WAL")
         cur.execute("PRAGMA foreign_keys")
 
-        cur.execute("BEGIN EXCLUSIVE TRANSACTION")
+        with self.stats.phase("lock_wait"):
+            cur.execute("BEGIN EXCLUSIVE TRANSACTION")
+
+        # Cache is only derived data, start over if schema is different
+        cur.execute("PRAGMA user_version")
+        migrate = cur.fetchone()[0] != cache_schema_version
+        if migrate:
+            cur.execute(
+                """SELECT name FROM sqlite_master
+                WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"""
+            )
+            for res in cur.fetchall():
+                cur.execute(f"DROP TABLE {res[0]}")
+            cur.execute(f"PRAGMA user_version = {cache_schema_version}")
+
+        # Generation is incremented on every change of cached rows. With
+        # random id of cache it gives key for data derived from cache.
+        # evaluated is generation logical typeattributesets were evaluated
+        # at, see update_logical_attributes.
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS generation
+            ( id TEXT NOT NULL
+            , generation INTEGER NOT NULL
+            , evaluated INTEGER NOT NULL
+            )"""
+        )
+        cur.execute("SELECT count(*) FROM generation")
+        if cur.fetchone()[0] == 0:
+            cur.execute("INSERT INTO generation VALUES (?, 0, 0)", (self.rand_str(16),))
 
         cur.execute(
             """CREATE TABLE IF NOT EXISTS files
-            ( file TEXT PRIMARY KEY
+            ( id INTEGER PRIMARY KEY
+            , file TEXT NOT NULL UNIQUE
             , mtime_us INTEGER NOT NULL
+            , digest TEXT NOT NULL
+            , fingerprint INTEGER
             )"""
         )
 
-        # perms: perms joined with " "
-        # optional: optional names joined with " "
-        # booleanvalue: true(1)/false(0) value of rules joined with " "
+        # Interned values, rule tables have only ids of these.
+        # names: types, attributes, classes, rule types and filenames
+        # permsets: perms of rule joined with " "
+        # contexts:
+        #   optional: json list of optional names and booleanif conditions
+        #   booleanvalue: true(1)/false(0) value of rules joined with " "
         cur.execute(
-            """CREATE TABLE IF NOT EXISTS te_rules
-            ( file TEXT NOT NULL
-            , string TEXT NOT NULL
-            , type TEXT NOT NULL
-            , source TEXT NOT NULL
-            , target TEXT NOT NULL
-            , class TEXT NOT NULL
-            , perms TEXT NOT NULL
+            """CREATE TABLE IF NOT EXISTS names
+            ( id INTEGER PRIMARY KEY
+            , name TEXT NOT NULL UNIQUE
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS permsets
+            ( id INTEGER PRIMARY KEY
+            , perms TEXT NOT NULL UNIQUE
+            )"""
+        )
+        # Bit of each permission in permission masks of class
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS class_perms
+            ( class INTEGER NOT NULL REFERENCES names(id)
+            , perm TEXT NOT NULL
+            , bit INTEGER NOT NULL
+            , PRIMARY KEY(class, perm)
+            ) WITHOUT ROWID"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS contexts
+            ( id INTEGER PRIMARY KEY
             , optional TEXT NOT NULL
             , booleanvalue TEXT NOT NULL
-            , FOREIGN KEY(file) REFERENCES files(file)
+            , UNIQUE(optional, booleanvalue)
             )"""
         )
+
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS te_rules
+            ( file INTEGER NOT NULL REFERENCES files(id)
+            , type INTEGER NOT NULL REFERENCES names(id)
+            , source INTEGER NOT NULL REFERENCES names(id)
+            , target INTEGER NOT NULL REFERENCES names(id)
+            , class INTEGER NOT NULL REFERENCES names(id)
+            , perms INTEGER NOT NULL REFERENCES permsets(id)
+            , permmask INTEGER NOT NULL
+            , permmask_ext BLOB
+            , context INTEGER NOT NULL REFERENCES contexts(id)
+            , fingerprint INTEGER NOT NULL
+            )"""
+        )
+        # Logical expressions can not be rebuilt from members, they are
+        # kept as JSON in expression. Members of non-logical sets are in
+        # typeattribute_members.
         cur.execute(
             """CREATE TABLE IF NOT EXISTS typeattributes
-            ( file TEXT NOT NULL
+            ( id INTEGER PRIMARY KEY
+            , file INTEGER NOT NULL REFERENCES files(id)
             , string TEXT NOT NULL
-            , type TEXT NOT NULL
-            , attrs TEXT NOT NULL
+            , type INTEGER NOT NULL REFERENCES names(id)
+            , expression TEXT
             , is_logical INTEGER DEFAULT (0)
-            , optional TEXT NOT NULL
-            , booleanvalue TEXT NOT NULL
-            , FOREIGN KEY(file) REFERENCES files(file)
+            , context INTEGER NOT NULL REFERENCES contexts(id)
+            , fingerprint INTEGER NOT NULL
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS typeattribute_members
+            ( typeattribute INTEGER NOT NULL REFERENCES typeattributes(id)
+            , member INTEGER NOT NULL REFERENCES names(id)
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS types
+            ( file INTEGER NOT NULL REFERENCES files(id)
+            , type INTEGER NOT NULL REFERENCES names(id)
+            , is_attribute INTEGER NOT NULL
             )"""
         )
+        # Transitive closure of typeattribute_members of all files:
+        # member is in attribute directly or through nested attributes.
+        # Types of logical typeattributesets are here too.
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS attribute_closure
+            ( member INTEGER NOT NULL REFERENCES names(id)
+            , attribute INTEGER NOT NULL REFERENCES names(id)
+            , PRIMARY KEY(member, attribute)
+            ) WITHOUT ROWID"""
+        )
         cur.execute(
             """CREATE TABLE IF NOT EXISTS typetransitions
-            ( file TEXT NOT NULL
-            , string TEXT NOT NULL
-            , subject TEXT NOT NULL
-            , source TEXT NOT NULL
-            , class TEXT NOT NULL
-            , target TEXT NOT NULL
-            , filename TEXT
-            , optional TEXT NOT NULL
-            , booleanvalue TEXT NOT NULL
-            , FOREIGN KEY(file) REFERENCES files(file)
+            ( file INTEGER NOT NULL REFERENCES files(id)
+            , subject INTEGER NOT NULL REFERENCES names(id)
+            , source INTEGER NOT NULL REFERENCES names(id)
+            , class INTEGER NOT NULL REFERENCES names(id)
+            , target INTEGER NOT NULL REFERENCES names(id)
+            , filename INTEGER REFERENCES names(id)
+            , context INTEGER NOT NULL REFERENCES contexts(id)
+            , fingerprint INTEGER NOT NULL
             )"""
         )
+        # value and string of labeling statements are only compared and
+        # shown, so they are kept as text.
+        for table, key in labeling_tables.items():
+            key_columns = "".join(f"\n            , {c} {t}" for c, t in key.items())
+            cur.execute(
+                f"""CREATE TABLE IF NOT EXISTS {table}
+            ( file INTEGER NOT NULL REFERENCES files(id){key_columns}
+            , value TEXT NOT NULL
+            , string TEXT NOT NULL
+            , context INTEGER NOT NULL REFERENCES contexts(id)
+            , fingerprint INTEGER NOT NULL
+            )"""
+            )
+
+        # Indexes for searches and for replacing rows of one file. Columns
+        # with equality match go first, IN lists after those.
+        for index, table, columns in cache_indexes:
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {index} ON {table}({', '.join(columns)})"
+            )
 
         con.commit()
-        self.cur = cur
-        self.con = con
+        if migrate:
+            # Give space of old tables back
+            cur.execute("VACUUM")
+
+    def forget_stale(self) -> None:
+        # Everything read from cache is kept while generation of cache and
+        # searched files stay same.
+        assert self.con is not None
+        assert self.cur is not None
+        self.cur.execute("SELECT id, generation FROM generation")
+        generation = cast(Tuple[str, int], tuple(self.cur.fetchone()))
+        if generation != self.generation:
+            if self.generation is None or self.generation[0] != generation[0]:
+                # Cache was created again
+                self.interned = {}
+            self.generation = generation
+            self.symbols = CacheSymbols(self.con)
+            self.known_files = None
+            self.searched_files = None
+        if self.files != self.searched_files:
+            self.searched_files = list(self.files)
+            for table in (self.files_table, self.membership_table):
+                if table:
+                    self.cur.execute(f"DROP TABLE {table}")
+            self.files_table = None
+            self.membership_table = None
+            self.__dict__.pop("type_bitsets", None)
 
     def refresh_cache(self) -> None:
         assert self.con is not None
         assert self.cur is not None
 
+        self.files = []
         if self.args.from_all_known:
-            self.cur.execute("SELECT file FROM files")
-            for res in self.cur.fetchall():
-                file1 = res[0]
-                if os.path.exists(file1):
-                    self.files.append(file1)
+            self.forget_stale()
+            # Removing file changes mtime of its directory
+            if dir_mtimes(self.known_dirs) != self.known_dirs:
+                self.known_files = None
+            if self.known_files is None:
+                self.cur.execute("SELECT file FROM files")
+                files = [res[0] for res in self.cur.fetchall()]
+                self.known_dirs = dir_mtimes(os.path.dirname(f) or "." for f in files)
+                self.known_files = [f for f in files if os.path.exists(f)]
+            self.files = list(self.known_files)
+            self.stats.count("files_known", len(self.files))
             return
 
+        self.open_writer()
+        assert self.write_con is not None
         files_no_need_to_update = set()
         for file1 in self.args.files:
             if os.path.exists(file1):
                 self.files.append(file1)
                 mtime_us = int(os.path.getmtime(file1) * 1000000)
-                self.cur.execute(
-                    """
-                    SELECT file FROM files
-                    WHERE file=:file AND mtime_us == :mtime_us
-                    """,
-                    {"file": file1, "mtime_us": mtime_us},
-                )
-                for res in self.cur.fetchall():
-                    files_no_need_to_update.add(res[0])
+                if not self.need_update(file1, mtime_us):
+                    files_no_need_to_update.add(file1)
         files_to_update = set(self.files) - files_no_need_to_update
+        self.stats.count("files_cached", len(files_no_need_to_update))
         # print(f'# files_to_update: {files_to_update}')
+        jobs = self.args.jobs or os.cpu_count() or 1
+        if jobs > 1 and len(files_to_update) > 1:
+            self.refresh_cache_parallel(files_to_update, jobs)
+            return
+        # File is parsed outside of transaction, so that writer keeps lock
+        # only while swapping rows of file.
         for idx, file1 in enumerate(files_to_update):
-            self.cur.execute("BEGIN EXCLUSIVE TRANSACTION")
+            if not os.path.exists(file1):
+                # file was removed in meantime
+                continue
+            mtime_us, digest = file_digest(file1)
+            self.begin_exclusive()
+            done = not self.need_update(file1, mtime_us) or self.reuse_cache_rows(
+                file1, mtime_us, digest
+            )
+            self.write_con.commit()
+            if done:
+                continue
 
-            need_update = False
-            if os.path.exists(file1):
-                need_update = True
-                mtime_us = int(os.path.getmtime(file1) * 1000000)
-                self.cur.execute(
-                    """
-                    SELECT file FROM files
-                    WHERE file=:file AND mtime_us == :mtime_us
-                    """,
-                    {"file": file1, "mtime_us": mtime_us},
-                )
-                for _ in self.cur.fetchall():
-                    need_update = False
-                    break
+            self.progress(f"# {idx+1}/{len(files_to_update)} {file1}")
+            rows = parse_cache_rows(file1, self.args.parser)
+            self.begin_exclusive()
+            if self.need_update(rows.file, rows.mtime_us):
+                self.write_cache_rows(rows)
+            # else some other process updated it in meantime
+            self.write_con.commit()
+
+    def begin_exclusive(self) -> None:
+        # Time waiting for other writers shows as lock_wait in --stats
+        assert self.write_cur is not None
+        with self.stats.phase("lock_wait"):
+            self.write_cur.execute("BEGIN EXCLUSIVE TRANSACTION")
+
+    def progress(self, text: str) -> None:
+        # Keeps --format jsonl output only JSON
+        print(text, file=sys.stderr if self.out.jsonl else sys.stdout)
 
-            if not need_update:
-                # file was removed/updated in meantime
-                self.con.commit()
+    def refresh_cache_parallel(self, files_to_update: Set[str], jobs: int) -> None:
+        # Workers only parse and flatten, this process is the only writer.
+        # Each content is parsed only once, other files with same content
+        # get copies of rows when it has been written.
+        assert self.write_con is not None
+        assert self.write_cur is not None
+        same_content: Dict[str, List[str]] = {}
+        by_digest: Dict[str, str] = {}
+        for file1 in files_to_update:
+            mtime_us, digest = file_digest(file1)
+            self.begin_exclusive()
+            reused = self.reuse_cache_rows(file1, mtime_us, digest)
+            self.write_con.commit()
+            if reused:
                 continue
+            if digest in by_digest:
+                same_content[by_digest[digest]].append(file1)
+                continue
+            by_digest[digest] = file1
+            same_content[file1] = []
+        if not same_content:
+            return
 
-            print(f"# {idx+1}/{len(files_to_update)} {file1}")
-            self.refresh_cache_one_file(file1)
-            self.con.commit()
+        # Only needed when refreshing with --jobs
+        import multiprocessing  # pylint: disable=import-outside-toplevel
 
-    def refresh_cache_one_file(self, file1: str) -> None:
-        assert self.cur is not None
-        with open(file1, "r") as fd:
-            mtime_us = int(os.path.getmtime(file1) * 1000000)
+        worker = functools.partial(parse_cache_rows_worker, parser=self.args.parser)
+        with multiprocessing.Pool(min(jobs, len(same_content))) as pool:
+            for idx, rows in enumerate(pool.imap_unordered(worker, same_content)):
+                self.begin_exclusive()
+                if self.need_update(rows.file, rows.mtime_us):
+                    self.progress(f"# {idx+1}/{len(same_content)} {rows.file}")
+                    self.write_cache_rows(rows)
+                # else some other process updated it in meantime
+                self.write_con.commit()
+                for file1 in same_content[rows.file]:
+                    self.begin_exclusive()
+                    if not self.reuse_cache_rows(file1, *file_digest(file1)):
+                        # changed in meantime
+                        self.write_cache_rows(parse_cache_rows(file1, self.args.parser))
+                    self.write_con.commit()
 
-            tree = grammar.parse(fd.read())
-            queue = cilp.visit(tree)
-            res = self.handle_file(queue, file1, [], [])
+    def reuse_cache_rows(self, file1: str, mtime_us: int, digest: str) -> bool:
+        # Content is already in cache: same file only gets new mtime and
+        # other file gets copy of rows of first file with same content.
+        assert self.write_cur is not None
+        self.write_cur.execute(
+            """SELECT id, file, fingerprint FROM files WHERE digest = ?
+            ORDER BY file != ?, id""",
+            (digest, file1),
+        )
+        res = self.write_cur.fetchone()
+        if res is None:
+            return False
+        if res["file"] == file1:
+            self.stats.count("files_touched")
+            self.write_cur.execute(
+                "UPDATE files SET mtime_us = ? WHERE id = ?", (mtime_us, res["id"])
+            )
+        else:
+            self.stats.count("files_copied")
+            self.copy_cache_rows(file1, mtime_us, digest, res["fingerprint"], res["id"])
+        return True
 
-            te_rules: TERulesSql = []
-            typeattributes: TASetsSql = []
-            typetransitions: TypetransitionsSql = []
+    def need_update(self, file1: str, mtime_us: int) -> bool:
+        assert self.write_cur is not None
+        self.write_cur.execute(
+            """
+            SELECT file FROM files
+            WHERE file=:file AND mtime_us == :mtime_us
+            """,
+            {"file": file1, "mtime_us": mtime_us},
+        )
+        return self.write_cur.fetchone() is None
 
-            for te in res[0]:
-                te_rules.append(te.sqldict())
-            for ta in res[1]:
-                typeattributes.append(ta.sqldict())
-            for tt in res[2]:
-                typetransitions.append(tt.sqldict())
+    def intern(self, table: str, columns: Sequence[str], values: Sequence[str]) -> int:
+        # Ids are never changed or removed, so they can be remembered even
+        # if other processes add more in meantime.
+        key = (table, *values)
+        if key in self.interned:
+            return self.interned[key]
+        assert self.write_cur is not None
+        self.write_cur.execute(
+            f"""INSERT OR IGNORE INTO {table}({", ".join(columns)})
+            VALUES ({", ".join("?" for _ in columns)})""",
+            values,
+        )
+        self.write_cur.execute(
+            f"SELECT id FROM {table} WHERE "
+            + " AND ".join(f"{c} = ?" for c in columns),
+            values,
+        )
+        self.interned[key] = self.write_cur.fetchone()[0]
+        return self.interned[key]
 
-            # pylint: disable=line-too-long
-            self.cur.execute(
-                """
-                DELETE FROM te_rules
-                WHERE file=:file
-                """,
-                {"file": file1},
-            )
-            self.cur.execute(
+    def intern_name(self, name: Optional[str]) -> Optional[int]:
+        if name is None:
+            return None
+        return self.intern("names", ("name",), (name,))
+
+    def intern_perm(self, klass: int, perm: str) -> int:
+        # New permission gets next free bit of class
+        key = ("class_perms", str(klass), perm)
+        if key in self.interned:
+            return self.interned[key]
+        assert self.write_cur is not None
+        self.write_cur.execute(
+            """INSERT OR IGNORE INTO class_perms(class, perm, bit)
+            SELECT :class, :perm, coalesce(max(bit) + 1, 0) FROM class_perms
+            WHERE class = :class""",
+            {"class": klass, "perm": perm},
+        )
+        self.write_cur.execute(
+            "SELECT bit FROM class_perms WHERE class = ? AND perm = ?", (klass, perm)
+        )
+        self.interned[key] = self.write_cur.fetchone()[0]
+        return self.interned[key]
+
+    def intern_permmask(
+        self, klass: str, perms: Sequence[str]
+    ) -> Tuple[int, Optional[bytes]]:
+        klass_id = self.intern("names", ("name",), (klass,))
+        return bits_to_permmask(self.intern_perm(klass_id, perm) for perm in perms)
+
+    def intern_context(
+        self, optional: Sequence[str], booleanvalue: Sequence[bool]
+    ) -> int:
+        return self.intern(
+            "contexts",
+            ("optional", "booleanvalue"),
+            (json.dumps(optional), bool_to_str10(booleanvalue)),
+        )
+
+    def clear_cache_rows(
+        self, file1: str, mtime_us: int, digest: str, fingerprint: Optional[int]
+    ) -> Tuple[int, Set[Tuple[int, int]]]:
+        # Returns id of file and its attribute members before clearing
+        assert self.write_cur is not None
+        self.write_cur.execute(
+            """
+            INSERT INTO files
+                   ( file,  mtime_us,  digest,  fingerprint)
+            VALUES (:file, :mtime_us, :digest, :fingerprint)
+            ON CONFLICT(file) DO UPDATE
+            SET mtime_us = excluded.mtime_us, digest = excluded.digest,
+                fingerprint = excluded.fingerprint
+            """,
+            {
+                "file": file1,
+                "mtime_us": mtime_us,
+                "digest": digest,
+                "fingerprint": fingerprint,
+            },
+        )
+        self.write_cur.execute("SELECT id FROM files WHERE file = ?", (file1,))
+        file_id = self.write_cur.fetchone()[0]
+        self.write_cur.execute("UPDATE generation SET generation = generation + 1")
+        old_members = self.attribute_members(file_id)
+
+        self.write_cur.execute(
+            """
+            DELETE FROM te_rules
+            WHERE file=:file
+            """,
+            {"file": file_id},
+        )
+        self.write_cur.execute(
+            """
+            DELETE FROM typeattribute_members
+            WHERE typeattribute IN (SELECT id FROM typeattributes WHERE file=:file)
+            """,
+            {"file": file_id},
+        )
+        self.write_cur.execute(
+            """
+            DELETE FROM typeattributes
+            WHERE file=:file
+            """,
+            {"file": file_id},
+        )
+        self.write_cur.execute(
+            """
+            DELETE FROM typetransitions
+            WHERE file=:file
+            """,
+            {"file": file_id},
+        )
+        self.write_cur.execute("DELETE FROM types WHERE file = ?", (file_id,))
+        for table in labeling_tables:
+            self.write_cur.execute(f"DELETE FROM {table} WHERE file = ?", (file_id,))
+        return file_id, old_members
+
+    def write_cache_rows(self, rows: "CacheRows") -> None:
+        # pylint: disable=too-many-locals
+        assert self.write_cur is not None
+        store = rows.rules
+        # Parsing may have been done in worker
+        self.stats.add_time("parse", rows.parse_seconds)
+        self.stats.add_time("flatten", rows.flatten_seconds)
+        self.stats.count("files_parsed")
+        self.stats.count("te_rules.rows_inserted", len(store.te_rules))
+        self.stats.count("typeattributes.rows_inserted", len(store.typeattributes))
+        self.stats.count("typetransitions.rows_inserted", len(store.typetransitions))
+        start = time.perf_counter()
+        file_id, old_members = self.clear_cache_rows(
+            rows.file, rows.mtime_us, rows.digest, rows.fingerprint
+        )
+
+        # Values interned in store are interned to cache once, in same
+        # order as rows use them.
+        names = store.names
+
+        @functools.lru_cache(maxsize=None)
+        def name(idx: Optional[int]) -> Optional[int]:
+            return None if idx is None else self.intern_name(names[idx])
+
+        @functools.lru_cache(maxsize=None)
+        def permset(idx: int) -> int:
+            return self.intern("permsets", ("perms",), (" ".join(store.permsets[idx]),))
+
+        @functools.lru_cache(maxsize=None)
+        def permmask(klass: int, perms: int) -> Tuple[int, Optional[bytes]]:
+            return self.intern_permmask(names[klass], store.permsets[perms])
+
+        @functools.lru_cache(maxsize=None)
+        def context(idx: int) -> int:
+            return self.intern_context(*store.contexts[idx])
+
+        te = store.te_rules.data
+        self.write_cur.executemany(
+            """
+            INSERT INTO te_rules
+                  (file, type, source, target, class, perms, permmask, permmask_ext,
+                   context, fingerprint)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    file_id,
+                    name(type_),
+                    name(source),
+                    name(target),
+                    name(klass),
+                    permset(perms),
+                    *permmask(klass, perms),
+                    context(ctx),
+                    fingerprint(
+                        "te_rules",
+                        names[type_],
+                        names[source],
+                        names[target],
+                        names[klass],
+                        *sorted(set(store.permsets[perms])),
+                    ),
+                )
+                for type_, source, target, klass, perms, ctx in zip(
+                    te["type"],
+                    te["source"],
+                    te["target"],
+                    te["class"],
+                    te["perms"],
+                    te["context"],
+                )
+            ],
+        )
+
+        for res in store.typeattributes.rows():
+            r = TASetView(res, store)
+            self.write_cur.execute(
                 """
-                DELETE FROM typeattributes
-                WHERE file=:file
+                INSERT INTO typeattributes
+                      (file, string, type, expression, is_logical, context,
+                       fingerprint)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
                 """,
-                {"file": file1},
+                (
+                    file_id,
+                    r.string,
+                    name(res["type"]),
+                    res["expression"],
+                    r.is_logical,
+                    context(res["context"]),
+                    self.taset_fingerprint(r),
+                ),
             )
-            self.cur.execute(
+            typeattribute = self.write_cur.lastrowid
+            self.write_cur.executemany(
                 """
-                DELETE FROM typetransitions
-                WHERE file=:file
+                INSERT INTO typeattribute_members
+                      (typeattribute, member)
+                VALUES(?, ?)
                 """,
-                {"file": file1},
+                [(typeattribute, name(int(a))) for a in res["attrs"].split(",") if a],
             )
 
-            self.cur.executemany(
-                """
-                INSERT INTO te_rules
-                      ( file,  string,  type,  source,  target,  class,  perms,  optional,  booleanvalue)
-                VALUES(:file, :string, :type, :source, :target, :class, :perms, :optional, :booleanvalue)
+        self.stats.count("types.rows_inserted", len(store.types))
+        self.write_cur.executemany(
+            "INSERT INTO types (file, type, is_attribute) VALUES(?, ?, ?)",
+            [
+                (file_id, name(type_), is_attribute)
+                for type_, is_attribute in zip(
+                    store.types.data["type"], store.types.data["is_attribute"]
+                )
+            ],
+        )
+
+        tt = store.typetransitions.data
+        self.write_cur.executemany(
+            """
+            INSERT INTO typetransitions
+                  (file, subject, source, class, target, filename, context, fingerprint)
+            VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    file_id,
+                    *(name(i) for i in ids),
+                    context(ctx),
+                    fingerprint(
+                        "typetransitions",
+                        *("" if i is None else names[i] for i in ids),
+                    ),
+                )
+                for *ids, ctx in zip(
+                    tt["subject"],
+                    tt["source"],
+                    tt["class"],
+                    tt["target"],
+                    tt["filename"],
+                    tt["context"],
+                )
+            ],
+        )
+
+        for table, key in labeling_tables.items():
+            labels = store.labels[table]
+            self.stats.count(f"{table}.rows_inserted", len(labels))
+            columns = ["file", *key, "value", "string", "context", "fingerprint"]
+            self.write_cur.executemany(
+                f"""
+                INSERT INTO {table} ({", ".join(columns)})
+                VALUES({", ".join("?" for _ in columns)})
                 """,
-                te_rules,
+                [
+                    (
+                        file_id,
+                        *labeled,
+                        res["value"],
+                        res["string"],
+                        context(res["context"]),
+                        fingerprint(table, *map(str, labeled), res["value"]),
+                    )
+                    for res in labels.rows()
+                    for labeled in [tuple(res[c] for c in key)]
+                ],
             )
+        self.update_attribute_closure(old_members, self.attribute_members(file_id))
+        self.stats.add_time("write_rows", time.perf_counter() - start)
 
-            self.cur.executemany(
+    @staticmethod
+    def taset_fingerprint(r: TASetView) -> int:
+        if not r.is_logical:
+            return fingerprint("typeattributes", r.type, *sorted(r.attrs))
+        return fingerprint("typeattributes", r.type, json.dumps(r.expression))
+
+    def copy_cache_rows(
+        self,
+        file1: str,
+        mtime_us: int,
+        digest: str,
+        file_fingerprint: Optional[int],
+        from_file_id: int,
+    ) -> None:
+        # Rows do not depend on file name, so copies are same as parsing
+        # would give, in same order.
+        assert self.write_cur is not None
+        start = time.perf_counter()
+        file_id, old_members = self.clear_cache_rows(
+            file1, mtime_us, digest, file_fingerprint
+        )
+        self.write_cur.execute(
+            """
+            INSERT INTO te_rules
+            SELECT ?, type, source, target, class, perms, permmask, permmask_ext,
+                   context, fingerprint
+            FROM te_rules WHERE file = ? ORDER BY rowid
+            """,
+            (file_id, from_file_id),
+        )
+        self.write_cur.execute(
+            """
+            SELECT id, string, type, expression, is_logical, context, fingerprint
+            FROM typeattributes WHERE file = ? ORDER BY id
+            """,
+            (from_file_id,),
+        )
+        for res in self.write_cur.fetchall():
+            self.write_cur.execute(
                 """
                 INSERT INTO typeattributes
-                      ( file,  string,  type,  attrs,  is_logical,  optional,  booleanvalue)
-                VALUES(:file, :string, :type, :attrs, :is_logical, :optional, :booleanvalue)
+                      (file, string, type, expression, is_logical, context,
+                       fingerprint)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
                 """,
-                typeattributes,
+                (file_id, *tuple(res)[1:]),
             )
-
-            self.cur.executemany(
+            self.write_cur.execute(
                 """
-                INSERT INTO typetransitions
-                      ( file,  string,  subject,  source,  class,  target,  filename,  optional,  booleanvalue)
-                VALUES(:file, :string, :subject, :source, :class, :target, :filename, :optional, :booleanvalue)
+                INSERT INTO typeattribute_members
+                SELECT ?, member FROM typeattribute_members
+                WHERE typeattribute = ? ORDER BY rowid
                 """,
-                typetransitions,
+                (self.write_cur.lastrowid, res["id"]),
             )
+        self.write_cur.execute(
+            """
+            INSERT INTO typetransitions
+            SELECT ?, subject, source, class, target, filename, context, fingerprint
+            FROM typetransitions WHERE file = ? ORDER BY rowid
+            """,
+            (file_id, from_file_id),
+        )
+        self.write_cur.execute(
+            """
+            INSERT INTO types
+            SELECT ?, type, is_attribute FROM types WHERE file = ? ORDER BY rowid
+            """,
+            (file_id, from_file_id),
+        )
+        for table, key in labeling_tables.items():
+            columns = ", ".join([*key, "value", "string", "context", "fingerprint"])
+            self.write_cur.execute(
+                f"""
+                INSERT INTO {table} (file, {columns})
+                SELECT ?, {columns} FROM {table} WHERE file = ? ORDER BY rowid
+                """,
+                (file_id, from_file_id),
+            )
+        self.update_attribute_closure(old_members, self.attribute_members(file_id))
+        self.stats.add_time("copy_rows", time.perf_counter() - start)
 
-            self.cur.execute(
+    def attribute_members(self, file_id: int) -> Set[Tuple[int, int]]:
+        assert self.write_cur is not None
+        self.write_cur.execute(
+            """
+            SELECT t.type, m.member
+            FROM typeattributes t
+            JOIN typeattribute_members m ON m.typeattribute = t.id
+            WHERE t.file = ?
+            """,
+            (file_id,),
+        )
+        return {(res[0], res[1]) for res in self.write_cur.fetchall()}
+
+    def update_attribute_closure(
+        self, old: Set[Tuple[int, int]], new: Set[Tuple[int, int]]
+    ) -> None:
+        # Removed member can take away pairs through any path, so
+        # attribute and all attributes containing it are recomputed.
+        # Same member may still come from other file.
+        assert self.write_cur is not None
+        start = time.perf_counter()
+        removed = set()
+        for attribute, member in old - new:
+            self.write_cur.execute(
                 """
-                REPLACE INTO files
-                       ( file,  mtime_us)
-                VALUES (:file, :mtime_us)
+                SELECT 1 FROM typeattributes t
+                JOIN typeattribute_members m ON m.typeattribute = t.id
+                WHERE t.type = ? AND m.member = ?
+                LIMIT 1
                 """,
-                {"file": file1, "mtime_us": mtime_us},
+                (attribute, member),
             )
+            if self.write_cur.fetchone() is None:
+                removed.add(attribute)
+        if removed:
+            tables: List[str] = []
+            try:
+                t = "temp_membership_" + self.rand_str(16)
+                self.write_cur.execute(
+                    f"CREATE TEMPORARY TABLE {t}(x INTEGER PRIMARY KEY)"
+                )
+                tables.append(t)
+                self.write_cur.executemany(
+                    f"INSERT OR IGNORE INTO {t} VALUES (?)", [(a,) for a in removed]
+                )
+                self.write_cur.execute(
+                    f"""
+                    INSERT OR IGNORE INTO {t}
+                    SELECT attribute FROM attribute_closure WHERE member IN {t}
+                    """
+                )
+                self.write_cur.execute(
+                    f"DELETE FROM attribute_closure WHERE attribute IN {t}"
+                )
+                # UNION drops duplicates, so cycles end too
+                self.write_cur.execute(
+                    f"""
+                    INSERT OR IGNORE INTO attribute_closure
+                    WITH RECURSIVE c(member, attribute) AS (
+                        SELECT m.member, t.type FROM {t}
+                        CROSS JOIN typeattributes t ON t.type = {t}.x
+                        CROSS JOIN typeattribute_members m ON m.typeattribute = t.id
+                        UNION
+                        SELECT m.member, c.attribute FROM c
+                        CROSS JOIN typeattributes t ON t.type = c.member
+                        CROSS JOIN typeattribute_members m ON m.typeattribute = t.id
+                    )
+                    SELECT member, attribute FROM c
+                    """
+                )
+            finally:
+                for t in tables:
+                    self.write_cur.execute(f"DROP TABLE {t}")
+        # Added member and everything in it are now also in attribute
+        # and all attributes containing it.
+        self.write_cur.executemany(
+            """
+            INSERT OR IGNORE INTO attribute_closure
+            SELECT d.member, a.attribute FROM
+                ( SELECT :member AS member
+                  UNION SELECT member FROM attribute_closure WHERE attribute = :member
+                ) d,
+                ( SELECT :attribute AS attribute
+                  UNION SELECT attribute FROM attribute_closure WHERE member = :attribute
+                ) a
+            """,
+            [{"attribute": a, "member": m} for a, m in new - old],
+        )
+        self.stats.add_time("attribute_closure", time.perf_counter() - start)
 
-    def load(self) -> None:
-        self.setup_cache()
-        self.refresh_cache()
-        self.handle_from_arg()
-
-    def handle_from_arg(self) -> None:
-        from_file = self.oargs["from"]
-        if from_file is not None:
-            print(f"# {1}/{1} {from_file.name}")
-            tree = grammar.parse(from_file.read())
-            cil_from = cilp.visit(tree)
-            self.cil_from = self.handle_file(cil_from, "cil_from", [], [])
+    def update_logical_attributes(self) -> None:
+        # Logical typeattributesets depend on attributes of all files, so
+        # they are evaluated once after refresh has written its files,
+        # unless some other process already did it for this generation.
+        assert self.write_con is not None
+        assert self.write_cur is not None
+        self.write_cur.execute("SELECT generation, evaluated FROM generation")
+        generation, evaluated = self.write_cur.fetchone()
+        if generation == evaluated:
+            return
+        self.begin_exclusive()
+        self.write_cur.execute("SELECT generation, evaluated FROM generation")
+        generation, evaluated = self.write_cur.fetchone()
+        if generation != evaluated:
+            start = time.perf_counter()
+            self.evaluate_logical_attributes()
+            # Data derived from attribute_closure is out of date too
+            self.write_cur.execute(
+                "UPDATE generation SET generation = ?, evaluated = ?",
+                (generation + 1, generation + 1),
+            )
+            self.stats.add_time("logical_attributes", time.perf_counter() - start)
+        self.write_con.commit()
 
-    def handle_file(
-        self, queue: List[Any], file1: str, op: List[Any], bv: List[bool]
-    ) -> ParsedCil:
-        # pylint: disable=too-many-locals
-        seen: set[str] = set()
-
-        te_rules: List["TERule"] = []
-        typeattributes: List["TASet"] = []
-        typetransitions: List["Typetransition"] = []
-
-        # First recurse and filter unique only per rule. Drop all
-        # cil_gen_requires as there is no info there for us.
-        while queue:
-            e = queue.pop(0)
-            if e[0] == "optional":
-                op2, bv2 = copy.copy(op), copy.copy(bv)
-                op2.append(e[1])
-                res = self.handle_file(e[2:], file1, op2, bv2)
-                te_rules.extend(res[0])
-                typeattributes.extend(res[1])
-                typetransitions.extend(res[2])
+    def evaluate_logical(
+        self,
+        cur: sqlite3.Cursor,
+        name_id: Callable[[str], int],
+        files_table: Optional[str] = None,
+    ) -> Tuple[List[int], Set[int], Dict[int, int]]:
+        # Types of each attribute as bitset over all types: declared ones
+        # and ones only seen in typeattributesets. Attribute is evaluated
+        # after attributes it has as member or in expression. With
+        # files_table, only members and expressions of those files count,
+        # over types and attributes of cached files that exist on disk.
+        # Returns types by bit, attributes and bitsets of attributes.
+        # pylint: disable=too-many-locals,too-many-branches
+        searched: Optional[Set[int]] = None
+        existing: Optional[Set[int]] = None
+        if files_table is not None:
+            cur.execute(f"SELECT x FROM {files_table}")
+            searched = {res[0] for res in cur.fetchall()}
+            cur.execute("SELECT id, file FROM files")
+            existing = {i for i, f in cur.fetchall() if os.path.exists(f)}
+
+        def ids(e: Union[str, CilExpression]) -> Any:
+            if isinstance(e, str):
+                return name_id(e)
+            if e and e[0] in logical_operators:
+                return [e[0], *map(ids, e[1:])]
+            return [ids(x) for x in e]
+
+        types: Set[int] = set()
+        attributes: Set[int] = set()
+        cur.execute("SELECT file, type, is_attribute FROM types")
+        for file, name, is_attribute in cur.fetchall():
+            if existing is None or file in existing:
+                (attributes if is_attribute else types).add(name)
+        depends: DefaultDict[int, Set[int]] = defaultdict(set)
+        exprs: DefaultDict[int, List[Any]] = defaultdict(list)
+        members: DefaultDict[int, List[int]] = defaultdict(list)
+        cur.execute("SELECT file, type, expression FROM typeattributes")
+        for file, attribute, expression in cur.fetchall():
+            if existing is not None and file not in existing:
                 continue
-            if e[0] == "booleanif":
-                for b in e[2:]:
-                    op2, bv2 = copy.copy(op), copy.copy(bv)
-                    op2.append(json.dumps(e[1]))
-                    bv2.append(b[0] == "true")
-                    res = self.handle_file(b[1:], file1, op2, bv2)
-                    te_rules.extend(res[0])
-                    typeattributes.extend(res[1])
-                    typetransitions.extend(res[2])
+            attributes.add(attribute)
+            if expression is None:
                 continue
-            if e[0] == "typeattributeset" and e[1] == "cil_gen_require":
+            e = ids(json.loads(expression))
+            names: Set[int] = set()
+            todo = [e]
+            while todo:
+                for x in todo.pop():
+                    if isinstance(x, list):
+                        todo.append(x)
+                    elif isinstance(x, int):
+                        names.add(x)
+            types |= names
+            if searched is None or file in searched:
+                exprs[attribute].append(e)
+                depends[attribute] |= names
+        cur.execute(
+            """SELECT t.file, t.type, m.member FROM typeattributes t
+            JOIN typeattribute_members m ON m.typeattribute = t.id"""
+        )
+        for file, attribute, member in cur.fetchall():
+            if existing is not None and file not in existing:
                 continue
-            if e[0] == "roleattributeset" and e[1] == "cil_gen_require":
+            types.add(member)
+            if searched is None or file in searched:
+                members[attribute].append(member)
+                depends[attribute].add(member)
+        types -= attributes
+        by_bit = sorted(types)
+        bits = {t: 1 << i for i, t in enumerate(by_bit)}
+        universe = (1 << len(bits)) - 1
+
+        # Depth first, members before attribute. Cycles are not valid
+        # policy, but then evaluation is repeated until it does not change.
+        order: List[int] = []
+        visited: Set[int] = set()
+        cyclic = False
+        for root in sorted(attributes):
+            if root in visited:
                 continue
+            visited.add(root)
+            stack = [(root, iter(sorted(depends[root] & attributes)))]
+            while stack:
+                attribute, it = stack[-1]
+                member = next(it, None)
+                if member is None:
+                    stack.pop()
+                    order.append(attribute)
+                elif member not in visited:
+                    visited.add(member)
+                    stack.append((member, iter(sorted(depends[member] & attributes))))
+                elif member not in order:
+                    cyclic = True
+
+        value: Dict[int, int] = {}
+
+        def evaluate(e: Union[int, List[Any]]) -> int:
+            if isinstance(e, int):
+                return value.get(e, 0) if e in attributes else bits[e]
+            if not e or e[0] not in logical_operators:
+                return functools.reduce(operator.or_, map(evaluate, e), 0)
+            if e[0] == "all":
+                return universe
+            if e[0] == "not":
+                return universe & ~evaluate(e[1])
+            op = {"and": operator.and_, "or": operator.or_, "xor": operator.xor}
+            return functools.reduce(op[e[0]], map(evaluate, e[1:]))
+
+        for _ in range(len(order) if cyclic else 1):
+            changed = False
+            for attribute in order:
+                v = functools.reduce(
+                    operator.or_,
+                    map(evaluate, members[attribute] + exprs[attribute]),
+                    0,
+                )
+                if value.get(attribute) != v:
+                    value[attribute] = v
+                    changed = True
+            if not changed:
+                break
+        self.stats.count("logical_attributes.evaluated", len(exprs))
+        return by_bit, attributes, value
+
+    def evaluate_logical_attributes(self) -> None:
+        # Evaluate attributes of all cached files, and make pairs of types
+        # in attribute_closure same as result. Pairs of attributes in
+        # attributes are kept as they are.
+        assert self.write_cur is not None
+        cur = self.write_cur
+        by_bit, attributes, value = self.evaluate_logical(
+            cur, lambda name: self.intern("names", ("name",), (name,))
+        )
+        bits = {t: 1 << i for i, t in enumerate(by_bit)}
+        cur.execute("SELECT member, attribute FROM attribute_closure")
+        current: DefaultDict[int, int] = defaultdict(int)
+        stale: List[Tuple[int, int]] = []
+        for member, attribute in cur.fetchall():
+            if member in bits:
+                current[attribute] |= bits[member]
+            elif member not in attributes:
+                stale.append((member, attribute))
+        added: List[Tuple[int, int]] = []
+        removed = stale
+        for attribute in attributes | current.keys():
+            v, c = value.get(attribute, 0), current[attribute]
+            added.extend((by_bit[i], attribute) for i in bit_indexes(v & ~c))
+            removed.extend((by_bit[i], attribute) for i in bit_indexes(c & ~v))
+        cur.executemany("INSERT OR IGNORE INTO attribute_closure VALUES (?, ?)", added)
+        cur.executemany(
+            "DELETE FROM attribute_closure WHERE member = ? AND attribute = ?",
+            removed,
+        )
+        self.stats.count("logical_attributes.pairs_added", len(added))
+        self.stats.count("logical_attributes.pairs_removed", len(removed))
+
+    def attribute_closure(self, column: str, ids: Iterable[int]) -> Set[int]:
+        # Attributes of member ids or members of attribute ids
+        assert self.cur is not None
+        assert column in ("member", "attribute")
+        other = "attribute" if column == "member" else "member"
+        table = self.sql_membership_table()
+        res: Set[int] = set()
+        todo = set(ids)
+        while todo:
+            found: Set[int] = set()
+            for i in todo:
+                self.cur.execute(
+                    f"SELECT {other} FROM {table} WHERE {column} = ?", (i,)
+                )
+                found.update(r[0] for r in self.cur.fetchall())
+            # attribute_closure has nested attributes already
+            if table == "attribute_closure":
+                return found
+            todo = found - res
+            res |= found
+        return res
+
+    def load(self) -> None:
+        if self.args.index:
+            self.load_index()
+            return
+        if self.con is None:
+            with self.stats.phase("setup_cache"):
+                self.setup_cache()
+        for con in (self.con, self.write_con):
+            if con is not None:
+                con.set_trace_callback(
+                    self.stats.trace if self.stats.target is not None else None
+                )
+        with self.stats.phase("refresh"):
+            self.refresh_cache()
+        if self.write_con is not None:
+            self.update_logical_attributes()
+        self.forget_stale()
+        if self.args.export_index:
+            with self.stats.phase("export_index"):
+                self.export_index()
+
+    def load_index(self) -> None:
+        # Search only what is in index, cache is only checked to be same
+        if self.index is None:
+            with self.stats.phase("setup_index"):
+                try:
+                    self.index = PolicyIndex(policy_index_file)
+                except (OSError, ValueError) as e:
+                    sys.exit(f"{policy_index_file}: {e}, see --export-index")
+        # Index is written from one generation of cache, and is stale once
+        # cache has been refreshed after it. Index without cache is used
+        # as it is.
+        if os.path.exists(cache_file):
+            try:
+                con = self.connect("ro")
+                try:
+                    key = list(
+                        con.execute("SELECT id, generation FROM generation").fetchone()
+                    )
+                finally:
+                    con.close()
+            except sqlite3.Error:
+                key = []
+            if key != self.index.key:
+                sys.exit(
+                    f"{policy_index_file}: {cache_file} has changed since, run --export-index again"
+                )
+        files = self.args.files
+        if self.args.from_all_known:
+            files = [self.index.files[i] for i in range(len(self.index.files))]
+        self.files = [f for f in files if os.path.exists(f)]
+
+    def export_index(self) -> None:
+        # Whole cache to PolicyIndex file. Interned values get ids by their
+        # position in index, names are sorted.
+        assert self.con is not None
+        assert self.cur is not None
+        sections: Dict[str, "array[int]"] = {}
+        ids: Dict[str, Dict[Optional[int], int]] = {}
+        pairs: List[Tuple[int, int]] = []
+        self.con.commit()
+        self.cur.execute("BEGIN")
+        try:
+            self.cur.execute("SELECT id, generation FROM generation")
+            key = list(self.cur.fetchone())
+            for table, query in (
+                ("names", "SELECT id, name FROM names"),
+                ("files", "SELECT id, file FROM files ORDER BY id"),
+                ("permsets", "SELECT id, perms FROM permsets ORDER BY id"),
+                (
+                    "contexts",
+                    "SELECT id, booleanvalue || char(9) || optional FROM contexts ORDER BY id",
+                ),
+            ):
+                rows = self.cur.execute(query).fetchall()
+                if table == "names":
+                    rows.sort(key=lambda res: res[1].encode())
+                ids[table] = {res[0]: idx for idx, res in enumerate(rows)}
+                ids[table][None] = -1
+                offsets, data = PolicyIndex.strings(res[1] for res in rows)
+                sections[f"{table}.offsets"] = offsets
+                sections[f"{table}.data"] = data
+            for table, columns in policy_index_columns.items():
+                self.cur.execute(
+                    f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid"
+                )
+                rows = self.cur.fetchall()
+                for i, (column, refs) in enumerate(columns.items()):
+                    sections[f"{table}.{column}"] = array(
+                        "i", [ids[refs][res[i]] for res in rows]
+                    )
+                for column in policy_index_keys:
+                    col = sections[f"{table}.{column}"]
+                    order = sorted(range(len(col)), key=col.__getitem__)
+                    sections[f"{table}.by_{column}.keys"] = array(
+                        "i", [col[i] for i in order]
+                    )
+                    sections[f"{table}.by_{column}.rows"] = array("i", order)
+            self.cur.execute("SELECT member, attribute FROM attribute_closure")
+            pairs = [(ids["names"][m], ids["names"][a]) for m, a in self.cur.fetchall()]
+        finally:
+            self.con.commit()
+        count = len(ids["names"]) - 1
+        for name, adjacent in (
+            ("attributes", pairs),
+            ("members", [(a, m) for m, a in pairs]),
+        ):
+            offsets, values = PolicyIndex.adjacency(adjacent, count)
+            sections[f"{name}.offsets"] = offsets
+            sections[f"{name}.values"] = values
+        PolicyIndex.write(policy_index_file, key, sections)
+
+    def search_from_files(self) -> None:
+        # Each file is searched and reported like it was only one
+        for from_file in self.oargs["from"]:
+            if self.args.output_dir is None:
+                self.search_from_file(from_file)
+                continue
+            name = os.path.splitext(os.path.basename(from_file))[0]
+            log = os.path.join(self.args.output_dir, f"{name}.log")
+            with open(f"{log}.tmp", "w", encoding="utf-8") as fd:
+                with redirect_stdout(fd):
+                    self.search_from_file(from_file)
+                    self.out.flush()
+            os.replace(f"{log}.tmp", log)
+
+    def search_from_file(self, from_file: str) -> None:
+        self.out.line(f"# {1}/{1} {from_file}", {"from": from_file})
+        with open(from_file, "r") as fd:
+            cil_from = parse_cil(fd.read(), self.args.parser)
+        self.from_file = from_file
+        self.cil_from = self.handle_file(cil_from, "cil_from", [], [])
+        self.search_from()
+
+    @classmethod
+    def handle_file(
+        cls, queue: List[Any], file1: str, op: List[Any], bv: List[bool]
+    ) -> RuleStore:
+        store = RuleStore(file1)
+
+        # Blocks are walked depth first with stack of their statements,
+        # context and unique statements. Rules are filtered unique only
+        # within block. Drop all cil_gen_requires as there is no info there
+        # for us.
+        stack: List[Tuple[Iterator[Any], int, Set[Tuple[Any, ...]]]] = [
+            (iter(queue), store.context(op, bv), set())
+        ]
+        while stack:
+            statements, context, seen = stack[-1]
+            op, bv = store.contexts[context]
+            for e in statements:
+                if e[0] == "optional":
+                    stack.append((iter(e[2:]), store.context(op + [e[1]], bv), set()))
+                    break
+                if e[0] == "booleanif":
+                    condition = json.dumps(e[1])
+                    stack.extend(
+                        (
+                            iter(b[1:]),
+                            store.context(op + [condition], [*bv, b[0] == "true"]),
+                            set(),
+                        )
+                        for b in reversed(e[2:])
+                    )
+                    break
+                if e[0] == "typeattributeset" and e[1] == "cil_gen_require":
+                    continue
+                if e[0] == "roleattributeset" and e[1] == "cil_gen_require":
+                    continue
+
+                # only show each entity once
+                key = expr_key(e)
+                if key in seen:
+                    continue
+                seen.add(key)
 
-            # only show each entity once
-            e_str = str(e)
-            if e_str in seen:
-                continue
-            seen.add(e_str)
-
-            if e[0] in type_enforcement_rule_types:
-                te = TERule.fromexpr(e, file1, op, bv)
-                te_rules.append(te)
-            elif e[0] == "typeattributeset":
-                ta = TASet.fromexpr(e, file1, op, bv)
-                typeattributes.append(ta)
-            elif e[0] == "typetransition":
-                tt = Typetransition.fromexpr(e, file1, op, bv)
-                typetransitions.append(tt)
-            elif e[0] in [
-                "allowx",
-                "category",
-                "categoryorder",
-                "class",
-                "classcommon",
-                "classorder",
-                "common",
-                "defaultrange",
-                "filecon",
-                "fsuse",
-                "genfscon",
-                "handleunknown",
-                "mls",
-                "mlsconstrain",
-                "policycap",
-                "portcon",
-                "rangetransition",
-                "role",
-                "roleallow",
-                "roleattribute",
-                "roleattributeset",
-                "roletransition",
-                "roletype",
-                "selinuxuser",
-                "selinuxuserdefault",
-                "sensitivity",
-                "sensitivitycategory",
-                "sensitivityorder",
-                "sid",
-                "sidcontext",
-                "sidorder",
-                "type",
-                "typealias",
-                "typealiasactual",
-                "typeattribute",
-                "typechange",
-                "typemember",
-                "typepermissive",
-                "user",
-                "userlevel",
-                "userprefix",
-                "userrange",
-                "userrole",
-            ]:
-                # TODO: We do not know what to do, so skip
-                # pylint: disable=pointless-statement
-                None
-            elif e[0] == "boolean":
-                # ['boolean', 'name', 'false']
-                # TODO: We do not know what to do, so skip
-                # pylint: disable=pointless-statement
-                None
+                if e[0] in type_enforcement_rule_types:
+                    store.add_te_rule(e, context)
+                elif e[0] == "typeattributeset":
+                    store.add_taset(e, context)
+                elif e[0] == "typetransition":
+                    store.add_typetransition(e, context)
+                elif e[0] in ("type", "typeattribute"):
+                    store.add_type(e)
+                elif e[0] in labeling_statement_types:
+                    store.add_label(e, context)
+                elif e[0] in ignored_statement_types:
+                    # TODO: We do not know what to do, so skip
+                    # pylint: disable=pointless-statement
+                    None
+                elif e[0] == "boolean":
+                    # ['boolean', 'name', 'false']
+                    # TODO: We do not know what to do, so skip
+                    # pylint: disable=pointless-statement
+                    None
+                else:
+                    # Unknown operand, give error, it probably needs to be added to above
+                    print(e)
+                    sys.exit(1)
             else:
-                # Unknown operand, give error, it probably needs to be added to above
-                print(e)
-                sys.exit(1)
+                stack.pop()
 
-        return (te_rules, typeattributes, typetransitions)
+        return store
 
     @staticmethod
     def rand_str(size: int) -> str:
@@ -732,26 +2689,99 @@ class CilSearcher:
             random.choice(string.ascii_letters + string.digits) for _ in range(size)
         )
 
+    def sql_files_table(self) -> Optional[str]:
+        # Files are same for every query, so fill table only once. If all
+        # cached files are searched, there is no need to filter at all.
+        assert self.cur is not None
+        if self.files_table is None:
+            self.cur.execute("SELECT file FROM files")
+            if {res[0] for res in self.cur.fetchall()} <= set(self.files):
+                self.files_table = ""
+            else:
+                self.files_table = "temp_files_" + self.rand_str(16)
+                self.cur.execute(f"CREATE TEMPORARY TABLE {self.files_table}(x)")
+                self.cur.executemany(
+                    f"INSERT INTO {self.files_table} SELECT id FROM files WHERE file = ?",
+                    [(a,) for a in self.files],
+                )
+        return self.files_table or None
+
+    def sql_membership_table(self) -> str:
+        # attribute_closure, or when only some cached files are searched,
+        # members of attributes of those files only. Those are not closed
+        # over nested attributes, users follow them until nothing is added.
+        # Logical attributes of those files are evaluated here over them.
+        assert self.cur is not None
+        assert self.symbols is not None
+        files_table = self.sql_files_table()
+        if files_table is None:
+            return "attribute_closure"
+        if self.membership_table is None:
+            table = "temp_membership_" + self.rand_str(16)
+            self.cur.execute(
+                f"""CREATE TEMPORARY TABLE {table}
+                (member INTEGER, attribute INTEGER, PRIMARY KEY(member, attribute))
+                WITHOUT ROWID"""
+            )
+            self.cur.execute(f"CREATE INDEX {table}_attribute ON {table}(attribute)")
+            self.cur.execute(
+                f"""
+                INSERT OR IGNORE INTO {table}
+                SELECT m.member, t.type FROM typeattributes t
+                JOIN typeattribute_members m ON m.typeattribute = t.id
+                WHERE t.file IN {files_table}
+                """
+            )
+            # Names only in expressions are not in cache, they can not be
+            # in any rule but still are types for "not" and "all".
+            unknown: Dict[str, int] = {}
+            symbols = self.symbols
+
+            def name_id(name: str) -> int:
+                i = symbols.id(name)
+                return i if i >= 0 else unknown.setdefault(name, -2 - len(unknown))
+
+            start = time.perf_counter()
+            by_bit, _, value = self.evaluate_logical(self.cur, name_id, files_table)
+            self.cur.execute(
+                f"SELECT DISTINCT type FROM typeattributes WHERE is_logical AND file IN {files_table}"
+            )
+            self.cur.executemany(
+                f"INSERT OR IGNORE INTO {table} VALUES (?, ?)",
+                [
+                    (by_bit[i], attribute)
+                    for attribute, in self.cur.fetchall()
+                    for i in bit_indexes(value.get(attribute, 0))
+                    if by_bit[i] >= 0
+                ],
+            )
+            self.stats.add_time("logical_attributes", time.perf_counter() - start)
+            self.membership_table = table
+        return self.membership_table
+
     def sql_temp_table_query(
         self,
         tables: List[str],
         multivars: List[Tuple[Set[str], str]],
         simplevars: List[str],
         full_query: str,
-    ) -> Tuple[str, List[str]]:
+        conditions: Sequence[str] = (),
+        vargs: Optional[Dict[str, Set[str]]] = None,
+    ) -> Tuple[str, List[int]]:
         assert self.cur is not None
+        assert self.symbols is not None
         rnd = self.rand_str(16)
+        if vargs is None:
+            vargs = self.vargs
 
-        args: List[str] = []
-        query: List[str] = []
+        args: List[int] = []
+        query: List[str] = list(conditions)
 
-        table = "temp_files_" + rnd
-        self.cur.execute(f"CREATE TEMPORARY TABLE {table}(x)")
-        tables.append(table)
-        self.cur.executemany(
-            f"INSERT INTO {table} VALUES (?)", [(a,) for a in self.files]
-        )
-        query.append(f"file IN {table}")
+        # Unary + keeps planner from using file index, indexes on searched
+        # columns are far more selective.
+        files_table = self.sql_files_table()
+        if files_table is not None:
+            query.append(f"+file IN {files_table}")
 
         for var, name in multivars:
             if var is not None:
@@ -760,63 +2790,87 @@ class CilSearcher:
                 tables.append(table)
                 self.cur.executemany(
                     f"INSERT INTO {table} VALUES (?)",
-                    [(a,) for a in self.vargs[name]],
+                    [(a,) for a in self.symbols.ids(vargs[name])],
                 )
-                query.append(f"{name} IN {table}")
+                if name.startswith("not_"):
+                    query.append(f"{name[4:]} NOT IN {table}")
+                else:
+                    query.append(f"{name} IN {table}")
 
         for k in simplevars:
+            if self.oargs[k] is None:
+                continue
             query.append(f"{k}=?")
-            args.append(self.oargs[k])
+            args.append(self.symbols.id(self.oargs[k]))
 
         if query:
             full_query = full_query + " WHERE " + " AND ".join(query)
 
         return (full_query, args)
 
-    def setup(self) -> None:
-        self.setup_tasets()
-
-    def setup_tasets(self) -> None:
-        assert self.cur is not None
-        tables: List[str] = []
+    # Attribute sets are loaded only when search needs them
+    def search(self) -> None:
         try:
-            full_query, args = self.sql_temp_table_query(
-                tables, [], [], "SELECT * FROM typeattributes"
-            )
-            self.cur.execute(full_query, args)
-            for res in self.cur.fetchall():
-                r = TASet.fromsqlrow(res)
-                self.tasets[r.type].append(r)
-                for attr in r.attrs:
-                    self.reverse_tasets[attr].append(r)
+            with self.stats.phase("search"):
+                if self.oargs["from"] is not None:
+                    self.search_from_files()
+                elif self.args.resolveattr:
+                    self.search_resolveattr()
+                elif self.args.dupes:
+                    self.search_dupes()
+                elif self.args.check_neverallow:
+                    self.search_neverallow()
+                elif self.args.attr:
+                    self.search_taset()
+                elif self.args.reverse_source or self.args.reverse_target:
+                    self.search_reverse()
+                elif any(
+                    self.oargs[k] is not None
+                    for k in (
+                        "type",
+                        "source",
+                        "target",
+                        "not_source",
+                        "not_target",
+                        "class",
+                    )
+                ):
+                    # Without any search criteria this is only cache refresh
+                    self.search_terule()
         finally:
-            for t in tables:
-                self.cur.execute(f"DROP TABLE {t}")
-
-    def search(self) -> None:
-        if self.cil_from is not None:
-            self.search_from()
-        elif self.args.resolveattr:
-            self.search_resolveattr()
-        elif self.args.attr:
-            self.search_taset()
-        else:
-            self.search_terule()
+            self.out.flush()
+            self.stats.report()
 
     def search_from(self) -> None:
-        # pylint: disable=too-many-branches, too-many-statements, too-many-locals
         assert self.cil_from is not None
-        seen: set[str] = set()
-        te_rules, _, typetransitions = self.cil_from
-        for r in te_rules:
-            self.oargs["type"] = r.type
-            self.oargs["source"] = r.source
-            self.oargs["target"] = r.target
-            self.oargs["class"] = r.klass
-            self.oargs["perms"] = r.perms
-            self.update_args()
-
-            got_all, got_any, missing_perms = self.search_terule(seen)
+        assert self.symbols is not None
+        seen: Set[Tuple[Any, ...]] = set()
+        store = self.cil_from
+        te_rules = [TERuleView(res, store) for res in store.te_rules.rows()]
+        typetransitions = [
+            TypetransitionView(res, store) for res in store.typetransitions.rows()
+        ]
+        # not_source/not_target from command line apply to all rules
+        self.update_args(expand=True)
+        permmasks = [self.symbols.permmask(r.klass, r.perms) for r in te_rules]
+        te_results = self.search_from_query(
+            "te_rules",
+            [
+                {
+                    "type": r.type,
+                    "class": r.klass,
+                    "source": r.source,
+                    "target": r.target,
+                    "permmask": mask,
+                    "permmask_ext": ext,
+                }
+                for r, (mask, ext, _) in zip(te_rules, permmasks)
+            ],
+        )
+        for r, rows, permmask in zip(te_rules, te_results, permmasks):
+            got_all, got_any, missing_perms = self.match_terules(
+                rows, r.klass, permmask, seen
+            )
             if got_all:
                 perms = " ".join(r.perms)
                 status = "found"
@@ -833,15 +2887,27 @@ class CilSearcher:
             else:
                 perms = " ".join(r.perms)
                 status = "no"
-            print(f"# {status}: ({r.type} {r.source} {r.target} ({r.klass} ({perms})))")
-        for t in typetransitions:
-            self.oargs["subject"] = t.subject
-            self.oargs["source"] = t.source
-            self.oargs["class"] = t.klass
-            self.oargs["filename"] = t.filename
-            self.oargs["target"] = t.target
-            self.update_args()
-            q = self.search_typetransition(seen)
+            rule = f"({r.type} {r.source} {r.target} ({r.klass} ({perms})))"
+            self.out.line(f"# {status}: {rule}", {"status": status, "rule": rule})
+        tt_results = self.search_from_query(
+            "typetransitions",
+            [
+                {
+                    "subject": t.subject,
+                    "class": t.klass,
+                    "source": t.source,
+                    "target": t.target,
+                    "filename": t.filename,
+                }
+                for t in typetransitions
+            ],
+        )
+        symbols = self.symbols
+        for t, rows in zip(typetransitions, tt_results):
+            q = self.match_typetransitions(
+                ((TypetransitionView(res, symbols), Quad[res["quad"]]) for res in rows),
+                seen,
+            )
             if q == Quad.TRUE:
                 status = "found"
             elif q == Quad.PARTIAL:
@@ -852,204 +2918,1195 @@ class CilSearcher:
                 status = "no"
             rpre = " ".join(["typetransitions", t.subject, t.source, t.klass])
             if t.filename is None:
-                print(f"# {status}: ({rpre} {t.target})")
+                rule = f"({rpre} {t.target})"
             else:
-                print(f"# {status}: ({rpre} {t.filename} {t.target})")
+                rule = f"({rpre} {t.filename} {t.target})"
+            self.out.line(f"# {status}: {rule}", {"status": status, "rule": rule})
+        for table in labeling_tables:
+            labels = [
+                LabelView(res, store, table) for res in store.labels[table].rows()
+            ]
+            for wanted, rows in zip(labels, self.search_labels(table, labels)):
+                # Same thing labeled otherwise is conflict
+                status = "no"
+                for res in rows:
+                    label = LabelView(res, symbols, table)
+                    if self.is_from_file(label):
+                        continue
+                    if label.value != wanted.value:
+                        status = "conflict"
+                    elif status == "no":
+                        status = "found"
+                    if self.handle_seen(seen, label):
+                        self.out.row(label)
+                rule = wanted.res["rule"]
+                self.out.line(f"# {status}: {rule}", {"status": status, "rule": rule})
+
+    def search_labels(
+        self, table: str, labels: List[LabelView]
+    ) -> List[List[sqlite3.Row]]:
+        # Cached rows labeling same thing as each of labels, like
+        # search_from_query does for rules
+        assert self.cur is not None
+        results: List[List[sqlite3.Row]] = [[] for _ in labels]
+        if not labels:
+            return results
+        key = list(labeling_tables[table])
+        tables: List[str] = []
+        try:
+            t = "temp_from_labels_" + self.rand_str(16)
+            self.cur.execute(
+                f"CREATE TEMPORARY TABLE {t}(idx INTEGER PRIMARY KEY, {', '.join(key)})"
+            )
+            tables.append(t)
+            self.cur.executemany(
+                f"INSERT INTO {t} VALUES (?, {', '.join('?' for _ in key)})",
+                [(idx, *r.labeled) for idx, r in enumerate(labels)],
+            )
+            full_query = f"""SELECT f.idx AS idx, r.* FROM {t} f
+                CROSS JOIN {table} r ON {self.labels_match_sql(table, "r", "f")}"""
+            files_table = self.sql_files_table()
+            if files_table is not None:
+                full_query += f" WHERE +r.file IN {files_table}"
+            full_query += " ORDER BY f.idx, r.rowid"
+            with self.stats.phase(f"from_query.{table}"):
+                rows = self.cur.execute(full_query)
+                for res in self.stats.counted(f"from_query.{table}", rows):
+                    results[res["idx"]].append(res)
+            return results
+        finally:
+            for t in tables:
+                self.cur.execute(f"DROP TABLE {t}")
+
+    @staticmethod
+    def labels_match_sql(table: str, a: str, b: str) -> str:
+        # Rows a and b label same thing, see labeling_tables. IS finds
+        # NULL file types of genfscons too, and uses key index like =.
+        if table == "portcons":
+            return (
+                f"{a}.protocol = {b}.protocol"
+                f" AND {a}.low <= {b}.high AND {a}.high >= {b}.low"
+            )
+        return " AND ".join(f"{a}.{c} IS {b}.{c}" for c in labeling_tables[table])
+
+    @staticmethod
+    def labels_match(a: LabelView, b: LabelView) -> bool:
+        # Same as labels_match_sql
+        if a.table == "portcons":
+            protocol, low, high = a.labeled
+            return bool(
+                protocol == b.res["protocol"]
+                and low <= b.res["high"]
+                and high >= b.res["low"]
+            )
+        return a.labeled == b.labeled
+
+    def search_from_query(
+        self, table: str, keys: List[Dict[str, Any]]
+    ) -> List[List[sqlite3.Row]]:
+        # Match all --from rules with one join instead of query per rule.
+        # Source and target are expanded through attributes like
+        # update_args does. Rows per rule are in rowid order like
+        # search_terule returns them. With
+        # permmask, rows get perms they have of wanted as gotmask. With
+        # filename, rows get Quad of filename_quad_sql as quad, and rules
+        # having filename fetch only rows with same or no filename.
+        assert self.cur is not None
+        assert self.symbols is not None
+        results: List[List[sqlite3.Row]] = [[] for _ in keys]
+        if not keys:
+            return results
+        rnd = self.rand_str(16)
+        tables: List[str] = []
+        columns = [k for k in keys[0] if k not in ("source", "target")]
+        simplevars = [k for k in columns if not k.startswith("permmask")]
+        namevars = simplevars
+        if "filename" in columns:
+            simplevars = [k for k in simplevars if k != "filename"]
+        try:
+            from_table = "temp_from_" + rnd
+            self.cur.execute(
+                f"""CREATE TEMPORARY TABLE {from_table}
+                (idx INTEGER PRIMARY KEY, {", ".join(columns)})"""
+            )
+            tables.append(from_table)
+            self.cur.executemany(
+                f"""INSERT INTO {from_table}
+                VALUES (?, {", ".join("?" for _ in columns)})""",
+                [
+                    (idx,)
+                    + tuple(
+                        self.symbols.id(k[v])
+                        if v in namevars and k[v] is not None
+                        else k[v]
+                        for v in columns
+                    )
+                    for idx, k in enumerate(keys)
+                ],
+            )
+            joins = [f"FROM {from_table} f"]
+            on = []
+            membership_table = self.sql_membership_table()
+            for name in ("source", "target"):
+                t = f"temp_from_{name}s_" + rnd
+                self.cur.execute(
+                    f"""CREATE TEMPORARY TABLE {t}
+                    (idx INTEGER, x, PRIMARY KEY(idx, x)) WITHOUT ROWID"""
+                )
+                tables.append(t)
+                self.cur.executemany(
+                    f"INSERT OR IGNORE INTO {t} VALUES (?, ?)",
+                    [
+                        (idx, a)
+                        for idx, k in enumerate(keys)
+                        for a in self.symbols.ids([k[name]])
+                    ],
+                )
+                # Until nested attributes of searched files add nothing
+                while True:
+                    self.cur.execute(
+                        f"""
+                        INSERT OR IGNORE INTO {t}
+                        SELECT {t}.idx, c.attribute FROM {t}
+                        CROSS JOIN {membership_table} c ON c.member = {t}.x
+                        """
+                    )
+                    if (
+                        membership_table == "attribute_closure"
+                        or self.cur.rowcount <= 0
+                    ):
+                        break
+                # CROSS JOIN fixes join order, so that all columns of
+                # index are used for searching cached rules.
+                joins.append(f"CROSS JOIN {t} ON {t}.idx = f.idx")
+                on.append(f"r.{name} = {t}.x")
+            on.extend(f"r.{k} = f.{k}" for k in simplevars)
+
+            query: List[str] = []
+            files_table = self.sql_files_table()
+            if files_table is not None:
+                query.append(f"+r.file IN {files_table}")
+            for name in ("not_source", "not_target"):
+                if self.oargs[name] is not None:
+                    t = f"temp_{name}s_" + rnd
+                    self.cur.execute(f"CREATE TEMPORARY TABLE {t}(x)")
+                    tables.append(t)
+                    self.cur.executemany(
+                        f"INSERT INTO {t} VALUES (?)",
+                        [(a,) for a in self.symbols.ids(self.vargs[name])],
+                    )
+                    query.append(f"r.{name[4:]} NOT IN {t}")
+
+            full_query = "SELECT f.idx AS idx, r.*"
+            if "permmask" in columns:
+                full_query += """
+                , r.permmask & f.permmask AS gotmask
+                , permmask_and(r.permmask_ext, f.permmask_ext) AS gotmask_ext"""
+            # Select, its joins and conditions
+            selects = [(full_query, joins, on, query)]
+            if "filename" in columns:
+                # Wanted filename and NULL for each rule having filename,
+                # IS finds both from last column of typetransitions index.
+                # Rules without filename get all rows.
+                t = "temp_from_filenames_" + rnd
+                self.cur.execute(f"CREATE TEMPORARY TABLE {t}(idx INTEGER, x)")
+                tables.append(t)
+                self.cur.execute(f"CREATE INDEX {t}_idx ON {t}(idx)")
+                self.cur.execute(
+                    f"""
+                    INSERT INTO {t}
+                    SELECT idx, filename FROM {from_table} WHERE filename IS NOT NULL
+                    UNION ALL
+                    SELECT idx, NULL FROM {from_table} WHERE filename IS NOT NULL
+                    """
+                )
+                selects = [
+                    (
+                        f"{full_query}, {self.filename_quad_sql('r.filename', False)}",
+                        joins,
+                        on,
+                        [*query, "f.filename IS NULL"],
+                    ),
+                    (
+                        f"{full_query}, {self.filename_quad_sql('r.filename', True)}",
+                        [*joins, f"CROSS JOIN {t} ON {t}.idx = f.idx"],
+                        [*on, f"r.filename IS {t}.x"],
+                        query,
+                    ),
+                ]
+            with self.stats.phase(f"from_query.{table}"):
+                for select, select_joins, select_on, conditions in selects:
+                    full_query = " ".join(
+                        [
+                            select,
+                            *select_joins,
+                            f"CROSS JOIN {table} r ON " + " AND ".join(select_on),
+                        ]
+                    )
+                    if conditions:
+                        full_query += " WHERE " + " AND ".join(conditions)
+                    full_query += " ORDER BY f.idx, r.rowid"
+                    rows = self.cur.execute(full_query)
+                    for res in self.stats.counted(f"from_query.{table}", rows):
+                        results[res["idx"]].append(res)
+            return results
+        finally:
+            for t in tables:
+                self.cur.execute(f"DROP TABLE {t}")
 
     @staticmethod
     def handle_seen(
-        seen: Optional[set[str]], r: Union[TERule, Typetransition, TASet]
+        seen: Optional[Set[Tuple[Any, ...]]],
+        r: RuleView,
     ) -> bool:
         if seen is None:
             return True
-        seen_key = " ".join((r.file, r.string))
+        seen_key = r.key
         # only show each entity once
         if seen_key in seen:
             return False
         seen.add(seen_key)
         return True
 
-    def search_terule(
-        self, seen: Optional[set[str]] = None
-    ) -> Tuple[bool, bool, FrozenSet[str]]:
-        assert self.cur is not None
-        got_all = True
-        got_any = False
-        missing_perms: Set[str] = set()
-        if self.oargs["perms"] is not None:
-            got_all = False
-            missing_perms.update(self.vargs["perms"])
-            wanted_perms = self.vargs["perms"]
+    def is_from_file(self, r: Union[TERuleView, TypetransitionView, LabelView]) -> bool:
+        return self.from_file is not None and (
+            self.from_file == r.file
+            or os.path.basename(self.from_file) == os.path.basename(r.file)
+        )
 
-        tables: List[str] = []
-        multivars = [
-            (self.args.source, "source"),
-            (self.args.target, "target"),
-            (self.args.not_source, "not_source"),
-            (self.args.not_target, "not_target"),
-        ]
+    def search_terule(self, seen: Optional[Set[Tuple[Any, ...]]] = None) -> None:
+        self.output_rows(self.terule_rows(), seen)
+
+    def terule_rows(
+        self, vargs: Optional[Dict[str, Set[str]]] = None
+    ) -> Iterator[TERuleView]:
+        # Names of source and target columns come from vargs when given,
+        # otherwise from arguments
+        if vargs is None:
+            vargs = {
+                k: self.vargs[k]
+                for k in ("source", "target", "not_source", "not_target")
+                if self.oargs[k] is not None
+            }
+        multivars = [(v, k) for k, v in vargs.items()]
         simplevars = ["class", "type"]
-        try:
-            full_query, args = self.sql_temp_table_query(
-                tables, multivars, simplevars, "SELECT * FROM te_rules"
+        if self.index is not None:
+            index = self.index
+            perms = self.vargs["perms"] if self.oargs["perms"] is not None else None
+            rows = self.index_rows("te_rules", multivars, simplevars, perms, vargs)
+            yield from (
+                TERuleView(res, index)
+                for res in self.stats.counted("search_terule", rows)
             )
-            self.cur.execute(full_query, args)
-            for res in self.cur.fetchall():
-                r = TERule.fromsqlrow(res)
-                if self.oargs["from"] is not None and (
-                    self.oargs["from"].name == r.file
-                    or os.path.basename(self.oargs["from"].name)
-                    == os.path.basename(r.file)
-                ):
-                    continue
-                if not self.handle_seen(seen, r):
-                    continue
-                if self.oargs["perms"] is not None:
-                    got_perms = set(r.perms)
-                    if wanted_perms.isdisjoint(got_perms):
-                        continue
-                    got_any = True
-                    missing_perms -= got_perms
-                    if not missing_perms:
-                        got_all = True
-                else:
-                    got_any = True
-                print(f"{r.file}:{r.string}")
-            return got_all, got_any, frozenset(missing_perms)
-        finally:
-            for t in tables:
-                self.cur.execute(f"DROP TABLE {t}")
-
-    def search_typetransition(self, seen: Optional[set[str]] = None) -> Quad:
+            return
         assert self.cur is not None
-        found = Quad.FALSE
+        assert self.symbols is not None
         tables: List[str] = []
-        multivars = [
-            (self.args.source, "source"),
-            (self.args.target, "target"),
-            (self.args.not_source, "not_source"),
-            (self.args.not_target, "not_target"),
-        ]
-        simplevars = ["class", "subject"]
         try:
+            full_query = "SELECT te_rules.* FROM te_rules"
+            conditions = []
+            if self.oargs["perms"] is not None:
+                # Rules having any of perms. Bits of perms depend on class.
+                table = "temp_permmasks_" + self.rand_str(16)
+                self.cur.execute(
+                    f"""CREATE TEMPORARY TABLE {table}
+                    (klass INTEGER PRIMARY KEY, mask INTEGER, mask_ext BLOB)"""
+                )
+                tables.append(table)
+                self.cur.executemany(
+                    f"INSERT INTO {table} VALUES (?, ?, ?)",
+                    [
+                        (klass, *bits_to_permmask(bits[p] for p in wanted))
+                        for klass, bits in self.symbols.class_perms.items()
+                        for wanted in [self.vargs["perms"] & bits.keys()]
+                        if wanted
+                    ],
+                )
+                full_query += f" CROSS JOIN {table} ON klass = te_rules.class"
+                conditions.append(
+                    "(permmask & mask OR permmask_and(permmask_ext, mask_ext) IS NOT NULL)"
+                )
             full_query, args = self.sql_temp_table_query(
-                tables, multivars, simplevars, "SELECT * FROM typetransitions"
+                tables, multivars, simplevars, full_query, conditions, vargs
+            )
+            # Rows are handled while they are read, fields only decoded when
+            # they are needed
+            rows = self.cur.execute(full_query + " ORDER BY te_rules.rowid", args)
+            symbols = self.symbols
+            yield from (
+                TERuleView(res, symbols)
+                for res in self.stats.counted("search_terule", rows)
             )
-            self.cur.execute(full_query, args)
-            for res in self.cur.fetchall():
-                r = Typetransition.fromsqlrow(res)
-                if self.oargs["from"] is not None and (
-                    self.oargs["from"].name == r.file
-                    or os.path.basename(self.oargs["from"].name)
-                    == os.path.basename(r.file)
-                ):
-                    continue
-                q = self.match_typetransition(r)
-                if q == Quad.FALSE:
-                    continue
-                if not self.handle_seen(seen, r):
-                    continue
-                print(f"{r.file}:{r.string}")
-                found = q
-            return found
         finally:
             for t in tables:
                 self.cur.execute(f"DROP TABLE {t}")
 
-    def search_taset(self, seen: Optional[set[str]] = None) -> bool:
+    def search_reverse(self) -> None:
+        # Rules reaching --reverse-source or --reverse-target type directly
+        # or through any attribute it is in, grouped by class and perm.
+        # Attributes come from attribute_closure kept up to date by cache
+        # refresh, rules from indexes of te_rules by source and by target.
+        vargs = {
+            k: self.vargs[k]
+            for k in ("source", "target", "not_source", "not_target")
+            if self.oargs[k] is not None
+        }
+        for key in ("source", "target"):
+            if not self.oargs[f"reverse_{key}"]:
+                continue
+            name = self.oargs[key]
+            if self.index is not None:
+                names = self.index.names
+                ids = [i for i in [names.find(name)] if i >= 0]
+                vargs[key] = {name}
+                vargs[key].update(
+                    names[i] for i in self.index.attribute_closure("member", ids)
+                )
+            else:
+                assert self.symbols is not None
+                vargs[key] = {name}
+                vargs[key].update(
+                    self.symbols.names[i]
+                    for i in self.attribute_closure("member", self.symbols.ids([name]))
+                )
+        rows = list(self.terule_rows(vargs))
+        if self.args.reverse_target:
+            # Rules of its attributes to self reach target type too
+            sources = vargs["target"] & vargs.get("source", vargs["target"])
+            rows.extend(
+                self.terule_rows({**vargs, "source": sources, "target": {"self"}})
+            )
+        groups: DefaultDict[Tuple[str, str], List[TERuleView]] = defaultdict(list)
+        for r in rows:
+            for perm in r.perms:
+                if self.oargs["perms"] is None or perm in self.vargs["perms"]:
+                    groups[(r.klass, perm)].append(r)
+        for (klass, perm), found in sorted(groups.items()):
+            self.stats.count("search_reverse.groups", 1)
+            self.out.line(f"# {klass} {perm}:", {"class": klass, "perm": perm})
+            for r in found:
+                self.out.row(r)
+
+    def index_rows(
+        self,
+        table: str,
+        multivars: List[Tuple[Set[str], str]],
+        simplevars: List[str],
+        perms: Optional[Set[str]] = None,
+        vargs: Optional[Dict[str, Set[str]]] = None,
+    ) -> Iterator[ColumnRow]:
+        # Same conditions as sql_temp_table_query, but from PolicyIndex
+        assert self.index is not None
+        if vargs is None:
+            vargs = self.vargs
+        names = self.index.names
+        wanted: Dict[str, Set[int]] = {}
+        unwanted: Dict[str, Set[int]] = {}
+        for var, name in multivars:
+            if var is not None:
+                ids = {names.find(a) for a in vargs[name]}
+                if name.startswith("not_"):
+                    unwanted[name[4:]] = ids
+                else:
+                    wanted[name] = ids
+        for k in simplevars:
+            if self.oargs[k] is not None:
+                wanted[k] = {names.find(self.oargs[k])}
+        files = self.index.files
+        known = {files[i]: i for i in range(len(files))}
+        if not known.keys() <= set(self.files):
+            wanted["file"] = {known[f] for f in self.files if f in known}
+        columns = self.index.tables[table]
+        return (
+            ColumnRow(columns, idx)
+            for idx in self.index.select(table, wanted, unwanted, perms)
+        )
+
+    def output_rows(
+        self,
+        rows: Iterable[Union[TERuleView, TypetransitionView]],
+        seen: Optional[Set[Tuple[Any, ...]]],
+    ) -> None:
+        for r in rows:
+            if self.is_from_file(r):
+                continue
+            if not self.handle_seen(seen, r):
+                continue
+            self.out.row(r)
+
+    def match_terules(
+        self,
+        rows: List[sqlite3.Row],
+        klass: str,
+        permmask: Tuple[int, Optional[bytes], Set[str]],
+        seen: Optional[Set[Tuple[Any, ...]]],
+    ) -> Tuple[bool, bool, FrozenSet[str]]:
+        # Rows come from search_from_query with gotmask. Rows without any
+        # wanted perms are still marked seen.
+        assert self.symbols is not None
+        mask, ext, unknown = permmask
+        missing = permmask_to_int(mask, ext)
+        got_any = False
+        for res in rows:
+            r = TERuleView(res, self.symbols)
+            if self.is_from_file(r):
+                continue
+            if not self.handle_seen(seen, r):
+                continue
+            got = permmask_to_int(res["gotmask"], res["gotmask_ext"])
+            if not got:
+                continue
+            got_any = True
+            missing &= ~got
+            self.out.row(r)
+        got_all = got_any and not missing and not unknown
+        return (
+            got_all,
+            got_any,
+            frozenset(unknown | self.symbols.mask_perms(klass, missing)),
+        )
+
+    def match_typetransitions(
+        self,
+        rows: Iterable[Tuple[TypetransitionView, Quad]],
+        seen: Optional[Set[Tuple[Any, ...]]],
+    ) -> Quad:
+        # Rows come with their Quad of filename_quad_sql, Quad.FALSE ones are
+        # already left out.
+        found = Quad.FALSE
+        for r, q in rows:
+            if self.is_from_file(r):
+                continue
+            if not self.handle_seen(seen, r):
+                continue
+            self.out.row(r)
+            found = q
+        return found
+
+    def search_taset(self, seen: Optional[Set[Tuple[Any, ...]]] = None) -> bool:
+        # Typeattributesets of searched files having --source or --target
+        # as member, see match_typeattributeset
+        assert self.cur is not None
+        assert self.symbols is not None
+        ids = self.symbols.ids(
+            self.oargs[k] for k in ("source", "target") if self.oargs[k] is not None
+        )
+        files_table = self.sql_files_table()
+        self.cur.execute(
+            f"""
+            SELECT *, {taset_attrs_column} FROM typeattributes
+            WHERE id IN (
+                SELECT typeattribute FROM typeattribute_members
+                WHERE member IN ({", ".join("?" for _ in ids)})
+            )
+            {f"AND +file IN {files_table}" if files_table else ""}
+            ORDER BY id
+            """,
+            ids,
+        )
         found = False
-        result: set[TASet] = set()
-        if "source" in self.vargs and self.vargs["source"] is not None:
-            for s in self.vargs["source"]:
-                if s in self.reverse_tasets:
-                    tas = self.reverse_tasets[self.args.source]
-                    if tas is not None:
-                        result.update(tas)
-        if "target" in self.vargs and self.vargs["target"] is not None:
-            for s in self.vargs["target"]:
-                if s in self.reverse_tasets:
-                    tas = self.reverse_tasets[self.args.target]
-                    if tas is not None:
-                        result.update(tas)
-        for r in result:
+        for res in self.stats.counted("search_taset", self.cur.fetchall()):
+            r = TASetView(res, self.symbols)
             if not self.match_typeattributeset(r):
                 continue
             found = True
             if not self.handle_seen(seen, r):
                 continue
-            print(f"{r.file}:{r.string}")
+            self.out.row(r)
         return found
 
+    def search_dupes(self) -> None:
+        # Files with same statements first. Rules of those are compared to
+        # other files only from first one of them.
+        assert self.cur is not None
+        assert self.symbols is not None
+        files_table = self.sql_files_table()
+        self.cur.execute(
+            "SELECT id, fingerprint FROM files WHERE fingerprint IS NOT NULL"
+            + (f" AND id IN {files_table}" if files_table else "")
+        )
+        same_files: Dict[int, List[int]] = defaultdict(list)
+        for res in self.cur.fetchall():
+            same_files[res["fingerprint"]].append(res["id"])
+        for ids in sorted(
+            sorted(self.symbols.files[i] for i in ids)
+            for ids in same_files.values()
+            if len(ids) > 1
+        ):
+            self.out.line(f"# dupes: {' '.join(ids)}", {"dupes": ids})
+
+        tables: List[str] = []
+        try:
+            files = "temp_dupes_files_" + self.rand_str(16)
+            self.cur.execute(f"CREATE TEMPORARY TABLE {files}(x INTEGER PRIMARY KEY)")
+            tables.append(files)
+            self.cur.executemany(
+                f"INSERT INTO {files} VALUES (?)",
+                [(min(ids),) for ids in same_files.values()],
+            )
+            views: List[Tuple[str, str, Callable[[sqlite3.Row, Symbols], RuleView]]] = [
+                ("te_rules", "*", TERuleView),
+                ("typeattributes", f"*, {taset_attrs_column}", TASetView),
+                ("typetransitions", "*", TypetransitionView),
+            ]
+            views.extend(
+                (table, "*", functools.partial(LabelView, table=table))
+                for table in labeling_tables
+            )
+            dupes = "temp_dupes_" + self.rand_str(16)
+            self.cur.execute(
+                f"""CREATE TEMPORARY TABLE {dupes} AS
+                SELECT fingerprint FROM (
+                    """
+                + "\n                    UNION ALL ".join(
+                    f"SELECT fingerprint, file FROM {table}" for table, _, _ in views
+                )
+                + f"""
+                )
+                WHERE file IN {files}
+                GROUP BY fingerprint HAVING count(*) > 1"""
+            )
+            tables.append(dupes)
+            groups: DefaultDict[int, List[RuleView]] = defaultdict(list)
+            for table, columns, cls in views:
+                self.cur.execute(
+                    f"""SELECT {columns} FROM {table}
+                    WHERE fingerprint IN {dupes} AND file IN {files}
+                    ORDER BY rowid"""
+                )
+                for res in self.stats.counted(f"search_dupes.{table}", self.cur):
+                    groups[res["fingerprint"]].append(cls(res, self.symbols))
+
+            # Same thing labeled otherwise, ports in overlapping ranges
+            conflicts: List[List[LabelView]] = []
+            for table, key in labeling_tables.items():
+                found: List[List[LabelView]] = []
+                self.cur.execute(
+                    f"""SELECT * FROM {table} r
+                    WHERE file IN {files} AND EXISTS (
+                        SELECT 1 FROM {table} o
+                        WHERE {self.labels_match_sql(table, "o", "r")}
+                        AND o.value != r.value AND o.file IN {files}
+                    )
+                    ORDER BY {", ".join(key)}, rowid"""
+                )
+                for res in self.stats.counted(f"search_dupes.{table}", self.cur):
+                    label = LabelView(res, self.symbols, table)
+                    if found and any(
+                        self.labels_match(label, other) for other in found[-1]
+                    ):
+                        found[-1].append(label)
+                    else:
+                        found.append([label])
+                conflicts.extend(found)
+        finally:
+            for t in tables:
+                self.cur.execute(f"DROP TABLE {t}")
+        for rows in sorted(groups.values(), key=lambda rows: rows[0].string):
+            where = "module" if len({r.file for r in rows}) == 1 else "modules"
+            self.out.line(f"# dupe rules in {where}:", {"dupe_rules_in": where})
+            for r in rows:
+                self.out.row(r)
+        for labels in conflicts:
+            where = "module" if len({r.file for r in labels}) == 1 else "modules"
+            self.out.line(
+                f"# conflicting labels in {where}:", {"conflicting_labels_in": where}
+            )
+            for label in labels:
+                self.out.row(label)
+
+    @functools.cached_property
+    def type_bitsets(self) -> Dict[int, int]:
+        # Bitset of types by name id. Each type has bit of its own and
+        # attribute has bits of all its member types, also through nested
+        # attributes of searched files. Names used in rules without any
+        # members are types.
+        assert self.cur is not None
+        with self.stats.phase("type_bitsets"):
+            table = self.sql_membership_table()
+            self.cur.execute(f"SELECT member, attribute FROM {table}")
+            members: DefaultDict[int, List[int]] = defaultdict(list)
+            for member, attribute in self.cur.fetchall():
+                members[attribute].append(member)
+            self.cur.execute(
+                f"""SELECT source FROM te_rules UNION SELECT target FROM te_rules
+                UNION SELECT member FROM {table}"""
+            )
+            types = sorted(r[0] for r in self.cur.fetchall() if r[0] not in members)
+            res = {t: 1 << bit for bit, t in enumerate(types)}
+            for attribute in list(members):
+                bits = 0
+                seen = {attribute}
+                todo = [attribute]
+                while todo:
+                    for member in members[todo.pop()]:
+                        if member not in members:
+                            bits |= res[member]
+                        elif member not in seen and table != "attribute_closure":
+                            # attribute_closure has nested attributes already
+                            seen.add(member)
+                            todo.append(member)
+                res[attribute] = bits
+            self.stats.count("type_bitsets.types", len(types))
+            return res
+
+    def search_neverallow(self) -> None:
+        # Allow rules giving some perm of neverallow rule to some pair of
+        # types it covers. Neverallows are numbered and sets of them are
+        # bitsets too: for each type, neverallows having it in source or
+        # target, and for each class and perm, ones having it. Unions of
+        # those for types of a name are made once for each name id, so
+        # each allow rule is checked with few dict lookups and ANDs.
+        assert self.cur is not None
+        assert self.symbols is not None
+        bitsets = self.type_bitsets
+        self_id = self.symbols.id("self")
+        files_table = self.sql_files_table()
+        files = f" AND file IN {files_table}" if files_table else ""
+        query = f"SELECT * FROM te_rules WHERE type = ?{files} ORDER BY rowid"
+        # Same neverallow in many files is checked once
+        neverallows: Dict[int, List[sqlite3.Row]] = defaultdict(list)
+        self.cur.execute(query, (self.symbols.id("neverallow"),))
+        for res in self.stats.counted("check_neverallow.neverallow", self.cur):
+            neverallows[res["fingerprint"]].append(res)
+        keys = list(neverallows)
+
+        perm_sets: DefaultDict[Tuple[int, int], int] = defaultdict(int)
+        # Neverallows by source and target name first, many have same
+        by_source: DefaultDict[int, int] = defaultdict(int)
+        by_target: DefaultDict[int, int] = defaultdict(int)
+        by_pair: DefaultDict[Tuple[int, int], int] = defaultdict(int)
+        self_mask = 0
+        for j, key in enumerate(keys):
+            n, bit = neverallows[key][0], 1 << j
+            for b in bit_indexes(permmask_to_int(n["permmask"], n["permmask_ext"])):
+                perm_sets[(n["class"], b)] |= bit
+            by_source[n["source"]] |= bit
+            if n["target"] == self_id:
+                self_mask |= bit
+                continue
+            by_target[n["target"]] |= bit
+            by_pair[(n["source"], n["target"])] |= bit
+        # Then by type. For allows to self, other neverallows by types in
+        # both their sides.
+        kinds: Dict[str, DefaultDict[int, int]] = {
+            "source": defaultdict(int),
+            "target": defaultdict(int),
+            "both": defaultdict(int),
+        }
+        for kind, by_name in (("source", by_source), ("target", by_target)):
+            for name, bits in by_name.items():
+                for b in bit_indexes(bitsets.get(name, 0)):
+                    kinds[kind][b] |= bits
+        for (source, target), bits in by_pair.items():
+            both = bitsets.get(source, 0) & bitsets.get(target, 0)
+            for b in bit_indexes(both):
+                kinds["both"][b] |= bits
+        # Self neverallows left after perms and source match are few, so
+        # types in both sides of allow are compared to them one by one
+        self_sources = {
+            j: bitsets.get(neverallows[keys[j]][0]["source"], 0)
+            for j in bit_indexes(self_mask)
+        }
+        # Types in no neverallow are skipped before taking unions
+        covered = {
+            kind: functools.reduce(operator.or_, (1 << b for b in sets), 0)
+            for kind, sets in kinds.items()
+        }
+
+        # Unions by name and permset id of allow, most of those are in
+        # many rules
+        cache: Dict[Tuple[str, int], int] = {}
+        perm_cache: Dict[Tuple[int, int], int] = {}
+
+        def cached(kind: str, name: int) -> int:
+            if (kind, name) not in cache:
+                sets = kinds[kind]
+                cache[(kind, name)] = functools.reduce(
+                    operator.or_,
+                    (
+                        sets[b]
+                        for b in bit_indexes(bitsets.get(name, 0) & covered[kind])
+                    ),
+                    0,
+                )
+            return cache[(kind, name)]
+
+        violations: DefaultDict[int, List[sqlite3.Row]] = defaultdict(list)
+        self.cur.execute(query, (self.symbols.id("allow"),))
+        for res in self.stats.counted("check_neverallow.allow", self.cur):
+            perms = (res["class"], res["perms"])
+            if perms not in perm_cache:
+                mask = permmask_to_int(res["permmask"], res["permmask_ext"])
+                perm_cache[perms] = functools.reduce(
+                    operator.or_,
+                    (perm_sets.get((perms[0], b), 0) for b in bit_indexes(mask)),
+                    0,
+                )
+            found = perm_cache[perms]
+            if found:
+                found &= cached("source", res["source"])
+            if not found:
+                continue
+            source, target = res["source"], res["target"]
+            if target == self_id:
+                hit = found & self_mask
+                hit |= found & cached("both", source)
+            else:
+                hit = found & cached("target", target)
+                if found & self_mask:
+                    both = bitsets.get(source, 0) & bitsets.get(target, 0)
+                    for j in bit_indexes(found & self_mask):
+                        if both & self_sources[j]:
+                            hit |= 1 << j
+            for j in bit_indexes(hit):
+                violations[keys[j]].append(res)
+
+        for key, rows in neverallows.items():
+            if key not in violations:
+                continue
+            found_rows = violations[key]
+            self.stats.count("check_neverallow.violations", len(found_rows))
+            self.out.line(
+                "# neverallow violated by allow rules:",
+                {"neverallow_violations": len(found_rows)},
+            )
+            for res in rows + found_rows:
+                self.out.row(TERuleView(res, self.symbols))
+
     def search_resolveattr(self) -> None:
+        # Source with all attributes it is in, target with all its members
         result: set[str] = set()
-        if "source" in self.vargs and self.vargs["source"] is not None:
-            for s in self.vargs["source"]:
-                if s in self.reverse_tasets:
-                    result.add(s)
-                    for r in self.reverse_tasets[s]:
-                        result.update(r.attrs)
-        if "target" in self.vargs and self.vargs["target"] is not None:
-            for t in self.vargs["target"]:
-                if t in self.tasets:
-                    result.add(t)
-                    result.update([r.type for r in self.tasets[t]])
+        for name, column in (("source", "member"), ("target", "attribute")):
+            if self.oargs[name] is None:
+                continue
+            if self.index is not None:
+                names = self.index.names
+                ids = [i for i in [names.find(self.oargs[name])] if i >= 0]
+                result.update(
+                    names[i]
+                    for i in self.index.attribute_closure(column, ids).union(ids)
+                )
+                continue
+            assert self.symbols is not None
+            ids = self.symbols.ids([self.oargs[name]])
+            result.update(
+                self.symbols.names[i]
+                for i in self.attribute_closure(column, ids).union(ids)
+            )
         for attr in sorted(result):
-            print(f"{attr}")
+            self.out.line(attr, {"name": attr})
 
-    def match_typeattributeset(self, taset: TASet) -> bool:
+    def match_typeattributeset(self, taset: TASetView) -> bool:
         if self.args.source is not None and self.args.source != taset.type:
             return False
         if self.args.target is not None and self.args.target not in taset.attrs:
             return False
         return True
 
-    def match_typetransition(self, r: Typetransition) -> Quad:
-        # pylint: disable=too-many-return-statements
-        if r.subject != self.oargs["subject"]:
-            return Quad.FALSE
-        if r.source not in self.vargs["source"]:
-            return Quad.FALSE
-        if r.target not in self.vargs["target"]:
-            return Quad.FALSE
-        if r.klass != self.oargs["class"]:
-            return Quad.FALSE
-        if self.oargs["filename"] is None:
-            if r.filename is not None:
-                return Quad.PARTIAL
-        else:
-            if r.filename is None:
-                return Quad.MORE
-            if self.oargs["filename"] != r.filename:
-                return Quad.FALSE
-        return Quad.TRUE
+    @staticmethod
+    def filename_quad_sql(column: str, wanted: bool) -> str:
+        # Quad of rows that have wanted filename or none. Without wanted
+        # filename, rows having one are PARTIAL, and with it rows having
+        # none are MORE. Rows of other filename are not selected.
+        if wanted:
+            return f"CASE WHEN {column} IS NULL THEN 'MORE' ELSE 'TRUE' END AS quad"
+        return f"CASE WHEN {column} IS NULL THEN 'TRUE' ELSE 'PARTIAL' END AS quad"
+
+
+@dataclass(frozen=True)
+class CacheRows:
+    file: str
+    mtime_us: int
+    digest: str
+    fingerprint: Optional[int]
+    rules: RuleStore
+    parse_seconds: float
+    flatten_seconds: float
+
+
+def dir_mtimes(dirs: Iterable[str]) -> Dict[str, Optional[int]]:
+    res: Dict[str, Optional[int]] = {}
+    for d in dirs:
+        try:
+            res[d] = os.stat(d).st_mtime_ns
+        except OSError:
+            res[d] = None
+    return res
+
+
+def file_digest(file1: str) -> Tuple[int, str]:
+    # mtime is read first, so that file changing while reading is noticed
+    # later from mtime
+    with open(file1, "rb") as fd:
+        mtime_us = int(os.path.getmtime(file1) * 1000000)
+        return mtime_us, hashlib.sha256(fd.read()).hexdigest()
+
+
+def statements_fingerprint(queue: List[Any]) -> Optional[int]:
+    # Statements of file in any order, like sort -u of exported module
+    statements = {
+        str(e)
+        for e in queue
+        if e[0] not in ("typeattributeset", "roleattributeset")
+        or e[1] != "cil_gen_require"
+    }
+    return fingerprint("file", *sorted(statements)) if statements else None
+
+
+def parse_cache_rows(file1: str, parser: str) -> CacheRows:
+    with open(file1, "rb") as fd:
+        mtime_us = int(os.path.getmtime(file1) * 1000000)
+        data = fd.read()
+    start = time.perf_counter()
+    queue = parse_cil(data.decode(), parser)
+    parsed = time.perf_counter()
+    # Strings of statements are freed before flattening
+    file_fingerprint = statements_fingerprint(queue)
+    rules = CilSearcher.handle_file(queue, file1, [], [])
+    return CacheRows(
+        file1,
+        mtime_us,
+        hashlib.sha256(data).hexdigest(),
+        file_fingerprint,
+        rules,
+        parsed - start,
+        time.perf_counter() - parsed,
+    )
+
+
+def parse_cache_rows_worker(file1: str, parser: str) -> CacheRows:
+    try:
+        return parse_cache_rows(file1, parser)
+    except SystemExit as e:
+        # handle_file exits on unknown statements, that would leave pool
+        # waiting for result forever.
+        raise RuntimeError(f"{file1}: parsing failed") from e
+
+
+# --server/--client protocol: client sends one JSON line with its cwd and
+# argv, server answers with JSON lines {"out": str}, {"err": str} and last
+# {"exit": int}.
+class ClientOutput(io.TextIOBase):
+    def __init__(self, wfile: io.BufferedIOBase, name: str) -> None:
+        super().__init__()
+        self.wfile = wfile
+        self.name = name
+        self.buf: List[str] = []
+        self.size = 0
+
+    def write(self, s: str) -> int:
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size > 65536:
+            self.flush()
+        return len(s)
+
+    def flush(self) -> None:
+        if self.buf:
+            msg = json.dumps({self.name: "".join(self.buf)}) + "\n"
+            self.wfile.write(msg.encode())
+            self.buf = []
+            self.size = 0
+
+
+class ThreadOutput(io.TextIOBase):
+    # Replaces sys.stdout and sys.stderr in server, so that output of each
+    # request goes to its own client.
+    def __init__(self, default: TextIO) -> None:
+        super().__init__()
+        self.default = default
+        self.local = threading.local()
+
+    def stream(self) -> TextIO:
+        return cast(TextIO, getattr(self.local, "stream", self.default))
+
+    def write(self, s: str) -> int:
+        return self.stream().write(s)
+
+    def flush(self) -> None:
+        self.stream().flush()
+
+
+class CilRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        server = cast(CilServer, self.server)
+        request = json.loads(self.rfile.readline())
+        outputs = (server.stdout, server.stderr)
+        streams = (ClientOutput(self.wfile, "out"), ClientOutput(self.wfile, "err"))
+        for output, stream in zip(outputs, streams):
+            output.local.stream = stream
+        try:
+            code = server.run(request)
+        finally:
+            for output, stream in zip(outputs, streams):
+                del output.local.stream
+                stream.flush()
+        self.wfile.write((json.dumps({"exit": code}) + "\n").encode())
+
+
+class CilServer(socketserver.ThreadingUnixStreamServer):
+    # Keeps searchers with their open cache, file list and attribute sets
+    # between requests. Each request thread takes idle searcher or creates
+    # new one.
+    daemon_threads = True
+
+    def __init__(self, path: str, parser: argparse.ArgumentParser) -> None:
+        self.parser = parser
+        self.lock = threading.Lock()
+        self.idle: List[CilSearcher] = []
+        self.stdout = ThreadOutput(sys.stdout)
+        self.stderr = ThreadOutput(sys.stderr)
+        sys.stdout = cast(TextIO, self.stdout)
+        sys.stderr = cast(TextIO, self.stderr)
+        super().__init__(path, CilRequestHandler)
+
+    def run(self, request: Dict[str, Any]) -> int:
+        # Returns exit code for client
+        if request["cwd"] != os.getcwd():
+            print(f"server is running in {os.getcwd()}", file=sys.stderr)
+            return 2
+        searcher = None
+        try:
+            args = parse_args(self.parser, request["argv"])
+            if args.server is not None or args.check_parser:
+                self.parser.error("--server and --check-parser are not for client")
+            with self.lock:
+                if self.idle:
+                    searcher = self.idle.pop()
+            if searcher is None:
+                searcher = CilSearcher(args)
+            else:
+                searcher.set_args(args)
+            searcher.load()
+            searcher.search()
+            # Filling temp tables leaves transaction open, that would keep
+            # snapshot of cache from the time of this search.
+            assert searcher.con is not None
+            searcher.con.commit()
+            with self.lock:
+                self.idle.append(searcher)
+            return 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            code = 1
+        # Searcher may be in middle of anything
+        if searcher is not None:
+            for con in (searcher.con, searcher.write_con):
+                if con is not None:
+                    con.close()
+        return code
+
+
+@contextlib.contextmanager
+def redirect_stdout(stream: TextIO) -> Iterator[None]:
+    # In server only output of this thread is redirected
+    if isinstance(sys.stdout, ThreadOutput):
+        old = sys.stdout.local.stream
+        sys.stdout.local.stream = stream
+        try:
+            yield
+        finally:
+            sys.stdout.local.stream = old
+    else:
+        with contextlib.redirect_stdout(stream):
+            yield
+
+
+def run_server(path: str, parser: argparse.ArgumentParser) -> None:
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(path)
+                sys.exit(f"server is already running in {path}")
+            except ConnectionRefusedError:
+                os.unlink(path)
+    with CilServer(path, parser) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+
+
+def run_client(path: str, argv: List[str]) -> int:
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        sock.sendall((json.dumps({"cwd": os.getcwd(), "argv": argv}) + "\n").encode())
+        with sock.makefile("rb") as f:
+            for line in f:
+                msg = json.loads(line)
+                if "exit" in msg:
+                    return int(msg["exit"])
+                if "out" in msg:
+                    sys.stdout.write(msg["out"])
+                else:
+                    sys.stderr.write(msg["err"])
+    sys.exit("server closed connection")
+
+
+def parse_args(
+    parser: argparse.ArgumentParser, argv: Optional[Sequence[str]] = None
+) -> argparse.Namespace:
+    args = parser.parse_args(argv)
+    # --from takes files, directories of *.cil files and globs
+    if vars(args)["from"] is not None:
+        from_files = []
+        for pattern in vars(args)["from"]:
+            if os.path.isdir(pattern):
+                found = sorted(glob.glob(os.path.join(glob.escape(pattern), "*.cil")))
+            elif os.path.exists(pattern):
+                found = [pattern]
+            else:
+                found = sorted(glob.glob(pattern))
+            if not found:
+                parser.error(f"argument --from: can't open '{pattern}'")
+            from_files.extend(found)
+        vars(args)["from"] = from_files
+    if args.index and (
+        vars(args)["from"]
+        or args.attr
+        or args.dupes
+        or args.check_neverallow
+        or args.export_index
+    ):
+        parser.error("argument --index: only rule searches and --resolveattr")
+    for key in ("source", "target"):
+        if not vars(args)[f"reverse_{key}"]:
+            continue
+        if vars(args)[key] is None:
+            parser.error(f"argument --reverse-{key}: needs --{key}")
+        if (
+            vars(args)["from"]
+            or args.attr
+            or args.resolveattr
+            or args.dupes
+            or args.check_neverallow
+        ):
+            parser.error(f"argument --reverse-{key}: only with rule searches")
+    if args.output_dir is not None and not os.path.isdir(args.output_dir):
+        parser.error(f"argument --output-dir: not a directory '{args.output_dir}'")
+    if args.output_dir is not None and vars(args)["from"]:
+        # Logs are named by file name only, see search_from_files
+        logs: Dict[str, str] = {}
+        for from_file in vars(args)["from"]:
+            name = os.path.splitext(os.path.basename(from_file))[0]
+            other = logs.setdefault(name, from_file)
+            if os.path.realpath(other) != os.path.realpath(from_file):
+                parser.error(
+                    f"argument --output-dir: '{other}' and '{from_file}' both write {name}.log"
+                )
+    return args
 
 
 def main() -> None:
-    parser = argparse.ArgumentParser(description="Parse and search cil files")
+    # @FILE reads arguments from FILE, one per line
+    parser = argparse.ArgumentParser(
+        description="Parse and search cil files", fromfile_prefix_chars="@"
+    )
     files_group = parser.add_mutually_exclusive_group(required=True)
     files_group.add_argument("files", metavar="FILES", type=str, nargs="*", default=[])
     files_group.add_argument("--from-all-known", action="store_true")
+    files_group.add_argument(
+        "--server",
+        metavar="SOCKET",
+        help="keep cache open and answer searches of --client from unix socket",
+    )
     type_group = parser.add_mutually_exclusive_group()
     type_group.add_argument("--type", choices=type_enforcement_rule_types)
     type_group.add_argument("--attr", action="store_true")
     type_group.add_argument("--resolveattr", action="store_true")
+    type_group.add_argument(
+        "--dupes",
+        action="store_true",
+        help="show files with same statements and rules found many times",
+    )
+    type_group.add_argument(
+        "--check-neverallow",
+        action="store_true",
+        help="show allow rules violating neverallow rules",
+    )
     parser.add_argument("--source", type=str)
     parser.add_argument("--not-source", type=str)
     parser.add_argument("--target", type=str)
     parser.add_argument("--not-target", type=str)
     parser.add_argument("--class", type=str)
     parser.add_argument("--perms", type=str)
-    parser.add_argument("--reverse-source", action="store_true")
-    parser.add_argument("--reverse-target", action="store_true")
-    parser.add_argument("--from", type=argparse.FileType("r"))
+    parser.add_argument(
+        "--reverse-source",
+        action="store_true",
+        help="rules of --source type and of attributes it is in, by class and perm",
+    )
+    parser.add_argument(
+        "--reverse-target",
+        action="store_true",
+        help="rules reaching --target type directly or through attributes, by class and perm",
+    )
+    parser.add_argument(
+        "--from",
+        action="append",
+        help="cil file, directory of them or glob, can be given many times",
+    )
+    parser.add_argument(
+        "--output-dir", help="write result of each --from file to OUTPUT_DIR/NAME.log"
+    )
+    parser.add_argument("--parser", choices=cil_parsers, default=cil_parsers[0])
+    parser.add_argument("--check-parser", action="store_true")
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="write timings and counters of phases as JSON to stderr",
+    )
+    parser.add_argument(
+        "--stats-file",
+        metavar="FILE",
+        help="append --stats line to FILE, also $SIMPLE_CIL_PARSER_STATS",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "jsonl"],
+        default="text",
+        help="jsonl gives each row and status line as JSON object",
+    )
+    parser.add_argument(
+        "--client", metavar="SOCKET", help="let --server in SOCKET do this search"
+    )
+    parser.add_argument(
+        "--export-index",
+        action="store_true",
+        help=f"write whole cache also to {policy_index_file} for --index",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help=f"search only {policy_index_file}, cache is not refreshed",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="parse modules with N processes when refreshing cache, 0 for all cores",
+    )
 
-    args = parser.parse_args()
+    args = parse_args(parser)
     # print(args)
     # sys.exit(0)
 
+    if args.check_parser:
+        sys.exit(0 if check_parser(args.files) else 1)
+
+    if args.server is not None:
+        run_server(args.server, parser)
+        return
+    if args.client is not None:
+        sys.stdout.flush()
+        sys.exit(run_client(args.client, sys.argv[1:]))
+
     cs = CilSearcher(args)
     cs.load()
-    cs.setup()
     cs.search()
 
 